@@ -0,0 +1,394 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import random
+import shutil
+import sqlite3
+import string
+import tempfile
+import time
+
+import iFly_Supp_FSL as fsl
+
+GOLDEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_golden.json")
+
+FIX_LEGS = ['IF', 'TF', 'CF', 'DF', 'RF', 'AF', 'HF', 'HM', 'HA', 'PI', 'FC', 'FD']
+NOFIX_LEGS = ['CA', 'VA', 'VM', 'FM', 'CD', 'VD', 'CI', 'VI', 'CR', 'VR', 'FA']
+PRO_COLUMNS = ['AREA_CODE', 'ARPT_IDENT', 'SUBS_CODE', 'PROC_IDENT', 'ROUTE_TYPE', 'TRANSITION_IDENT', 'SEQ_NR',
+               'FIX_IDENT', 'FIX_SECT_CODE', 'FIX_SUBS_CODE', 'WAYPOINT_DESCR_CODE', 'TURN_DIR', 'RECOMMENDED_NAVAID',
+               'THETA', 'RHO', 'MAG_COURSE', 'ROUTE_DISTANCE_HOLDING_DISTANCE_OR_TIME', 'PATH_AND_TERMINATION',
+               'ALT_DESCR', 'ALT_1', 'ALT_2', 'SPEED_LIMIT', 'SPEED_LIMIT_DESCR', 'VERTICAL_ANGLE',
+               'CENTER_FIX_OR_TAA_PROCEDURE_TURN_IND', 'MULTIPLE_CODE_OR_TAA_SECTOR_SECT_CODE',
+               'MULTIPLE_CODE_OR_TAA_SECTOR_SUBS_CODE']
+
+
+def generate_fsl(out_dir: str, n_airports: int, seed: int = 1) -> None:
+    """writes a synthetic FSL cycle of n_airports (up to 70,000) to out_dir, same seed gives same files,
+    with duplicate idents, RF legs, missing and unknown type fixes and an airport absent from AIRPORT.csv"""
+    rnd = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+
+    def ident(n: int) -> str:
+        return ''.join(rnd.choice(string.ascii_uppercase) for _ in range(n))
+    airports = []
+    seen = set()
+    while len(airports) < n_airports:
+        arpt = rnd.choice('ZVRK') + ident(3)
+        if arpt not in seen:
+            seen.add(arpt)
+            airports.append((arpt, rnd.uniform(-60, 60), rnd.uniform(-179, 179)))
+    apt_rows, rwy_rows, wpt_rows, vhf_rows, ndb_rows, pro_rows = [], [], [], [], [], []
+
+    def enroute(name: str, lat: float, lon: float) -> None:
+        wpt_rows.append(dict(SECT_CODE='E', SUBS_CODE='A', REGION_CODE='ENRT', WAYPOINT_IDENT=name,
+                             WAYPOINT_LAT=lat, WAYPOINT_LON=lon, WAYPOINT_TYPE='C'))
+    # navaids and enroute waypoints, some idents at several places
+    names = [ident(5) for _ in range(max(20, n_airports * 3))]
+    for name in names:
+        for _ in range(rnd.choice([1, 1, 2, 3])):
+            _, lat, lon = rnd.choice(airports)
+            enroute(name, lat + rnd.uniform(-2, 2), lon + rnd.uniform(-2, 2))
+    vors = [ident(3) for _ in range(max(10, n_airports))]
+    for name in vors:
+        for _ in range(rnd.choice([1, 2])):
+            _, lat, lon = rnd.choice(airports)
+            vhf_rows.append(dict(SECT_CODE='D', SUBS_CODE='', VOR_IDENT=name, VOR_FREQ=113.1,
+                                 VOR_LAT=lat + rnd.uniform(-1, 1), VOR_LON=lon + rnd.uniform(-1, 1)))
+    for name in [ident(2) for _ in range(max(10, n_airports))]:
+        _, lat, lon = rnd.choice(airports)
+        ndb_rows.append(dict(SECT_CODE=rnd.choice('DP'), SUBS_CODE='B', NDB_IDENT=name, NDB_FREQ=300,
+                             NDB_LAT=lat + rnd.uniform(-1, 1), NDB_LON=lon + rnd.uniform(-1, 1)))
+    for arpt, lat, lon in airports:
+        apt_rows.append(dict(AREA_CODE='EEU', ARPT_IDENT=arpt, ARPT_NAME=f"{arpt} INTL", ARPT_LAT=lat, ARPT_LON=lon,
+                             ARPT_ELEV=rnd.choice([100, 2000, 5000, 7300, 12000]),
+                             TRANSITIONS_ALT=rnd.choice(['', 3000, 9800, 18000]),
+                             TRANSITION_LEVEL=rnd.choice(['', 3600, 11800, 19000])))
+        rwys = []
+        for _ in range(rnd.choice([0, 1, 2, 3])):
+            n = rnd.randint(1, 18)
+            for side in rnd.choice([[''], ['L', 'R'], ['C']]):
+                for rw in [f"RW{n:02d}{side}", f"RW{n + 18:02d}{ {'L': 'R', 'R': 'L'}.get(side, side)}"]:
+                    if rw not in rwys:
+                        rwys.append(rw)
+        for rw in rwys:
+            rwy_rows.append(dict(ARPT_IDENT=arpt, RUNWAY_IDENT=rw, RUNWAY_LAT=lat + rnd.uniform(-.02, .02),
+                                 RUNWAY_LON=lon + rnd.uniform(-.02, .02), RUNWAY_LEN=3000))
+        terms = [ident(5) for _ in range(6)]
+        local = [ident(5) for _ in range(3)]
+        for name in local:
+            enroute(name, lat + rnd.uniform(-3, 3), lon + rnd.uniform(-3, 3))
+            if rnd.random() < 0.3:  # same ident far away
+                _, far_lat, far_lon = rnd.choice(airports)
+                enroute(name, far_lat, far_lon)
+            names.append(name)
+        for name in terms:
+            wpt_rows.append(dict(SECT_CODE='P', SUBS_CODE='C', REGION_CODE=arpt, WAYPOINT_IDENT=name,
+                                 WAYPOINT_LAT=lat + rnd.uniform(-.5, .5), WAYPOINT_LON=lon + rnd.uniform(-.5, .5),
+                                 WAYPOINT_TYPE='W'))
+
+        def fix() -> tuple:
+            c = rnd.random()
+            if c < 0.4:
+                return rnd.choice(terms), 'P', 'C'
+            if c < 0.6:
+                return rnd.choice(local), 'E', 'A'
+            if c < 0.65:
+                return rnd.choice(names), 'E', 'A'
+            if c < 0.75:
+                return rnd.choice(vors), 'D', ''
+            if c < 0.82:
+                ndb = rnd.choice(ndb_rows)
+                return ndb['NDB_IDENT'], ndb['SECT_CODE'], 'B' if ndb['SECT_CODE'] == 'D' else 'N'
+            if c < 0.88 and rwys:
+                return rnd.choice(rwys), 'P', 'G'
+            if c < 0.93:  # missing
+                return ident(5), rnd.choice(['E', 'P']), rnd.choice(['A', 'C'])
+            if c < 0.96:
+                return '', '', ''
+            return rnd.choice(names), 'X', 'Z'  # unknown type
+
+        def legs(n: int) -> list:
+            rows = []
+            for k in range(n):
+                leg_type = 'IF' if k == 0 else rnd.choice(FIX_LEGS + NOFIX_LEGS)
+                row = {}
+                if leg_type in FIX_LEGS or rnd.random() < 0.2:
+                    row['FIX_IDENT'], row['FIX_SECT_CODE'], row['FIX_SUBS_CODE'] = fix()
+                row['PATH_AND_TERMINATION'] = leg_type
+                row['WAYPOINT_DESCR_CODE'] = rnd.choice(['', 'E   ', 'EY  ', 'EB M', 'E  M', 'GY M', 'E', 'V  B'])
+                row['TURN_DIR'] = rnd.choice(['', '', 'L', 'R', 'E'])
+                row['MAG_COURSE'] = rnd.choice(['', 123.4, 55, 359.9])
+                row['SPEED_LIMIT'] = rnd.choice(['', '   ', ' 210', '250'])
+                row['SPEED_LIMIT_DESCR'] = rnd.choice(['', '+', '-', ' '])
+                row['ALT_1'] = rnd.choice(['', 3000, 12000, 4500])
+                row['ALT_2'] = rnd.choice([2000, 9000])
+                row['ALT_DESCR'] = rnd.choice(['', '+', '-', 'B', 'C', 'J', 'V', 'Y', 'G', '@'])
+                row['RECOMMENDED_NAVAID'] = rnd.choice(['', ' ', rnd.choice(vors), 'I' + ident(3)])
+                row['VERTICAL_ANGLE'] = rnd.choice(['', '', -3.0, -2.8])
+                row['THETA'] = rnd.choice(['', 1234, 90, 3599])
+                row['RHO'] = rnd.choice(['', 120, 55])
+                row['ROUTE_DISTANCE_HOLDING_DISTANCE_OR_TIME'] = rnd.choice(['', '0120', 'T010', '0045', ' ', 'X12'])
+                if leg_type == 'RF':
+                    c = rnd.random()
+                    if c < 0.85:  # found or missing center fix
+                        row['CENTER_FIX_OR_TAA_PROCEDURE_TURN_IND'] = rnd.choice(terms) if c < 0.7 else ident(4)
+                        row['MULTIPLE_CODE_OR_TAA_SECTOR_SECT_CODE'] = 'P'
+                        row['MULTIPLE_CODE_OR_TAA_SECTOR_SUBS_CODE'] = 'C'
+                    else:
+                        row['CENTER_FIX_OR_TAA_PROCEDURE_TURN_IND'] = ' '
+                rows.append(row)
+            return rows
+        procs = []  # (subs, route type, ident, transition, legs)
+        for _ in range(rnd.randint(0, 4)):  # SIDs
+            proc = ident(3) + str(rnd.randint(1, 9)) + rnd.choice('ABCDE')
+            kind = rnd.random()
+            if kind < 0.4 and rwys:  # runway transitions extended by the common route
+                for rw in rnd.sample(rwys, min(len(rwys), 2)):
+                    procs.append(('D', rnd.choice('14'), proc, rw, legs(rnd.randint(1, 5))))
+                procs.append(('D', rnd.choice('25'), proc, 'ALL', legs(rnd.randint(2, 5))))
+            elif kind < 0.7:
+                procs.append(('D', rnd.choice('25'), proc, rnd.choice(['ALL', '']), legs(rnd.randint(2, 5))))
+                if rwys:
+                    procs.append(('D', rnd.choice('14'), proc, rwys[0][:4] + 'B', legs(rnd.randint(2, 4))))
+            else:
+                procs.append(('D', rnd.choice('14'), proc, rnd.choice(rwys) if rwys else 'RW01',
+                              legs(rnd.randint(2, 5))))
+            for _ in range(rnd.randint(0, 2)):
+                procs.append(('D', rnd.choice('36'), proc, rnd.choice(names), legs(rnd.randint(2, 4))))
+            if rnd.random() < 0.1:  # route type not exported
+                procs.append(('D', '0', proc, rnd.choice(rwys) if rwys else 'RW01', legs(2)))
+        for _ in range(rnd.randint(0, 4)):  # STARs
+            proc = ident(3) + str(rnd.randint(1, 9)) + rnd.choice('ABCDE')
+            for _ in range(rnd.randint(0, 2)):
+                procs.append(('E', rnd.choice('14'), proc, rnd.choice(names), legs(rnd.randint(2, 4))))
+            if rwys and rnd.random() < 0.5:
+                for rw in rnd.sample(rwys, min(len(rwys), 2)):
+                    procs.append(('E', rnd.choice('36'), proc, rw, legs(rnd.randint(2, 4))))
+                procs.append(('E', rnd.choice('25'), proc, 'ALL', legs(rnd.randint(2, 5))))
+            else:
+                procs.append(('E', rnd.choice('25'), proc, rnd.choice(['ALL', '']), legs(rnd.randint(2, 5))))
+                procs.append(('E', rnd.choice('36'), proc, (rwys[0][:4] + 'B') if rwys else 'RW01B', legs(2)))
+        for _ in range(rnd.randint(0, 4)):  # approaches
+            if rwys and rnd.random() < 0.8:
+                rw = rnd.choice(rwys)
+                proc = rnd.choice('IRDLN') + rw[2:] + rnd.choice(['', '', 'Z', 'Y'])
+            else:  # runway not in ident
+                proc = rnd.choice(['VDMA', 'NDBB', 'VORA', 'R'])
+            for _ in range(rnd.randint(0, 2)):
+                procs.append(('F', 'A', proc, rnd.choice(names), legs(rnd.randint(2, 4))))
+            procs.append(('F', proc[0], proc, '', legs(rnd.randint(2, 6))))
+        procs.sort(key=lambda x: (x[0], x[2]))  # grouped by airport, subsection, then procedure ident
+        for subs, route_type, proc, trans, rows in procs:
+            for i, row in enumerate(rows):
+                pro_rows.append(dict(AREA_CODE='EEU', ARPT_IDENT=arpt, SUBS_CODE=subs, PROC_IDENT=proc,
+                                     ROUTE_TYPE=route_type, TRANSITION_IDENT=trans, SEQ_NR=(i + 1) * 10, **row))
+    orphan = 'ZZZZ' if 'ZZZZ' not in seen else 'WZZZ'  # generated idents never start with W
+    pro_rows.append(dict(AREA_CODE='EEU', ARPT_IDENT=orphan, SUBS_CODE='D', PROC_IDENT='ORP1A', ROUTE_TYPE='2',
+                         TRANSITION_IDENT='ALL', SEQ_NR=10, PATH_AND_TERMINATION='IF', FIX_IDENT=names[0],
+                         FIX_SECT_CODE='E', FIX_SUBS_CODE='A'))
+    for name, rows, cols in [
+        ('AIRPORT.csv', apt_rows, ['AREA_CODE', 'ARPT_IDENT', 'ARPT_NAME', 'ARPT_LAT', 'ARPT_LON', 'ARPT_ELEV',
+                                   'TRANSITIONS_ALT', 'TRANSITION_LEVEL']),
+        ('RUNWAY.csv', rwy_rows, ['ARPT_IDENT', 'RUNWAY_IDENT', 'RUNWAY_LAT', 'RUNWAY_LON', 'RUNWAY_LEN']),
+        ('WAYPOINT.csv', wpt_rows, ['SECT_CODE', 'SUBS_CODE', 'REGION_CODE', 'WAYPOINT_IDENT', 'WAYPOINT_LAT',
+                                    'WAYPOINT_LON', 'WAYPOINT_TYPE']),
+        ('VHF_NAVAID.csv', vhf_rows, ['SECT_CODE', 'SUBS_CODE', 'VOR_IDENT', 'VOR_FREQ', 'VOR_LAT', 'VOR_LON']),
+        ('NDB_NAVAID.csv', ndb_rows, ['SECT_CODE', 'SUBS_CODE', 'NDB_IDENT', 'NDB_FREQ', 'NDB_LAT', 'NDB_LON']),
+        ('AIRPORT_PROCEDURE.csv', pro_rows, PRO_COLUMNS),
+    ]:
+        with open(os.path.join(out_dir, name), 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=cols, restval='')
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+CEILING_WARNING = b"[WARN] Memory went over the ceiling"  # only logged by streamed runs
+
+
+def output_digests(output_dir: str) -> dict:
+    """returns {path: sha256} of every file of a conversion, Report.json excluded as it holds timings,
+    and the memory ceiling warning of a streamed run left out of Log.txt"""
+    digests = {}
+    for root, dirs, files in os.walk(output_dir):
+        for file in files:
+            file_path = os.path.join(root, file)
+            name = os.path.relpath(file_path, output_dir).replace(os.sep, '/')
+            if name == "Report.json":
+                continue
+            content = open(file_path, 'rb').read()
+            if name == "Log.txt":
+                content = b'\r\n'.join(line for line in content.split(b'\r\n') if not line.startswith(CEILING_WARNING))
+            digests[name] = hashlib.sha256(content).hexdigest()
+    return dict(sorted(digests.items()))
+
+
+def timed(func, *args) -> float:
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def fix_lookups() -> list:
+    """args of every find_a_point call made by the procedure exporters"""
+    legs = fsl.DATA.leg_table
+    lookups = []
+    for arpt, leg_type, pt_name, sect_code, subs_code, pt_cfix, cfix_sect, cfix_subs in zip(
+            legs.arpt, legs.leg_type, legs.pt_name, legs.fix_sect, legs.fix_subs,
+            legs.cfix, legs.cfix_sect, legs.cfix_subs):
+        if leg_type in FIX_LEGS and isinstance(pt_name, str) and subs_code != 'G':
+            lookups.append((pt_name, arpt, sect_code, subs_code))
+        if leg_type == 'RF' and isinstance(pt_cfix, str) and pt_cfix.strip():
+            lookups.append((pt_cfix.strip(), arpt, cfix_sect, cfix_subs))
+    return lookups
+
+
+def bench(data_dir: str, work_dir: str, repeat: int = 3) -> dict:
+    """returns {stage: best seconds of repeat} with each exporter timed in isolation, files kept in memory"""
+    times = {}
+
+    def best(stage: str, func, *args) -> None:
+        times[stage] = min(timed(func, *args) for _ in range(repeat))
+    fsl.ECHO = False
+    fsl.DATA = fsl.FSLDataset(data_dir)
+    times['load'] = timed(lambda: [getattr(fsl.DATA, t) for t in ['apt', 'rwy', 'pro', 'wpt', 'vhf', 'ndb']])
+    times['index'] = timed(lambda: (fsl.DATA.fix_index, fsl.DATA.leg_table, fsl.DATA.procedure_groups))
+    sink = fsl.BufferSink()
+    for stage, exporter in [('supp', fsl.export_airport_supp), ('sid', fsl.export_airport_sid),
+                            ('star', fsl.export_airport_star), ('app', fsl.export_airport_app)]:
+        best(stage, lambda: exporter(fsl.BufferSink()))
+        exporter(sink)
+
+    def package() -> None:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        for sub in ['Supp', 'Sid', 'Star']:
+            os.makedirs(os.path.join(work_dir, sub))
+        out = fsl.OutputSink(work_dir, True, f"{work_dir}-CHN-PROC-FULL.zip")
+        for name, content in sink.files:
+            out.write(name, content)
+        out.close()
+    best('package', package)
+    lookups = fix_lookups()
+    best('find_a_point', lambda: [fsl.find_a_point(*args) for args in lookups])
+    times['find_a_point_us'] = times['find_a_point'] / max(1, len(lookups)) * 1e6
+    fsl.LOG.clear()
+    fsl.ECHO = True
+    return times
+
+
+def check_golden(data_dir: str, work_dir: str, key: str, golden: dict, update: bool) -> bool:
+    """converts data_dir and compares each output file with the stored digests, then converts it again with 2 jobs,
+    streamed in small parts, for one airport prefix, for a box with a fix radius and twice incrementally,
+    whose files must match the same digests (only those of the selected airports for subsets,
+    Log.txt aside where it lists other airports or none), the SQLite databases of the serial and 2 jobs runs
+    must hold the same rows, True if all identical, None if there are no golden files for key"""
+    fsl.ECHO = False
+    try:
+        database = os.path.join(work_dir, "golden.sqlite")
+        completed = fsl.convert(data_dir, os.path.join(work_dir, "golden"), quiet=True, database=database)
+        digests = output_digests(os.path.join(work_dir, "golden"))
+        if update:
+            golden[key] = digests
+            return completed
+        expected = golden.get(key)
+        if expected is None:
+            print(f"  no golden files for {key}, run with --update-golden to store them")
+            return None
+        same = compare_digests("serial", expected, digests) and completed
+        prefix = min(name for name in expected if name.startswith("Supp/"))[len("Supp/")]
+        bbox = (-30, -90, 30, 90)
+        with open(os.path.join(data_dir, "AIRPORT.csv"), newline='') as f:
+            in_bbox = {row['ARPT_IDENT'] for row in csv.DictReader(f)
+                       if bbox[0] <= float(row['ARPT_LAT']) <= bbox[2] and bbox[1] <= float(row['ARPT_LON']) <= bbox[3]}
+        for variant, options, runs, selected in [
+            ('jobs', {'jobs': 2, 'database': os.path.join(work_dir, "golden-jobs.sqlite")}, 1, None),
+            ('stream', {'stream_mb': (fsl.current_rss_mb() or 0) + 64}, 1, None),  # parts of a few MB
+            ('prefix', {'subset': fsl.Subset(prefixes=(prefix,))}, 1, lambda arpt: arpt.startswith(prefix)),
+            ('bbox', {'subset': fsl.Subset(bbox=bbox, radius_km=100)}, 1, lambda arpt: arpt in in_bbox),
+            ('incremental', {'incremental': True}, 2, None),  # the second run converts nothing
+        ]:
+            output_dir = os.path.join(work_dir, f"golden-{variant}")
+            for _ in range(runs):
+                completed = fsl.convert(data_dir, output_dir, quiet=True, **options)
+            digests = output_digests(output_dir)
+            wanted = expected
+            if selected is not None:
+                wanted = {name: digest for name, digest in expected.items()
+                          if name == "Installation.txt" or '/' in name and selected(name.split('/')[1].split('.')[0])}
+            if selected is not None or variant == 'incremental':
+                wanted = {name: digest for name, digest in wanted.items() if name != "Log.txt"}
+                digests.pop("Log.txt", None)
+            same &= compare_digests(variant, wanted, digests) and completed
+            if 'database' in options and database_rows(options['database']) != database_rows(database):
+                print(f"  {variant} database differs from the serial run")
+                same = False
+        return same
+    finally:
+        fsl.ECHO = True
+
+
+def database_rows(path: str) -> list:
+    """every row of the procedures and legs tables of a database written with --database"""
+    with sqlite3.connect(path) as db:
+        return [db.execute(f"SELECT * FROM {table} ORDER BY 1, 2").fetchall() for table in ['procedures', 'legs']]
+
+
+def compare_digests(variant: str, expected: dict, digests: dict) -> bool:
+    """prints the files that differ from the expected digests, True if none"""
+    changed = sorted(n for n in expected.keys() | digests.keys() if expected.get(n) != digests.get(n))
+    for name in changed[:20]:
+        print(f"  {variant} {'missing' if name not in digests else 'unexpected' if name not in expected else 'changed'}: "
+              f"{name}")
+    if len(changed) > 20:
+        print(f"  ... {len(changed) - 20} more")
+    return not changed
+
+
+def main(sizes: list, seed: int = 1, repeat: int = 3, check: bool = True, update_golden: bool = False,
+         report: str = '') -> bool:
+    golden = json.load(open(GOLDEN_PATH)) if os.path.exists(GOLDEN_PATH) else {}
+    results = {}
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            key = f"{n}-{seed}"
+            data_dir = os.path.join(tmp, f"FSL-{key}")
+            start = time.perf_counter()
+            generate_fsl(data_dir, n, seed)
+            print(f"{n} airports (seed {seed}), generated in {time.perf_counter() - start:.2f}s")
+            times = bench(data_dir, os.path.join(tmp, f"iFly-{key}"), repeat)
+            for stage, value in times.items():
+                print(f"  {stage:<16}{value:10.1f} us" if stage.endswith('_us') else f"  {stage:<16}{value:10.3f} s")
+            if check or update_golden:
+                same = check_golden(data_dir, tmp, key, golden, update_golden)
+                print(f"  golden: {'updated' if update_golden else 'skipped' if same is None else 'identical' if same else 'DIFFERENT'}")
+                ok &= same is not False
+            results[key] = times
+            shutil.rmtree(data_dir)
+    if update_golden:
+        json.dump(golden, open(GOLDEN_PATH, 'w'), indent=0, sort_keys=True)
+    if report:
+        json.dump(results, open(report, 'w'), indent=2)
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Times the converter on synthetic FSL cycles and checks its output")
+    parser.add_argument('-n', '--airports', type=int, nargs='+', default=[100, 1000],
+                        help="sizes of the generated cycles (default: 100 1000)")
+    parser.add_argument('-s', '--seed', type=int, default=1, help="generator seed (default: 1)")
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help="runs per timed stage, the best is reported (default: 3)")
+    parser.add_argument('--no-check', action='store_true', help="skip the golden file comparison")
+    parser.add_argument('--update-golden', action='store_true',
+                        help="store the current output as golden instead of comparing")
+    parser.add_argument('--report', default='', help="also write the timings to this JSON file")
+    parser.add_argument('--generate', metavar='DIR',
+                        help="only write the cycle of the first size to DIR, e.g. to run the converter on")
+    args = parser.parse_args()
+    if args.generate:
+        generate_fsl(args.generate, args.airports[0], args.seed)
+    else:
+        raise SystemExit(0 if main(args.airports, args.seed, args.repeat, not args.no_check,
+                                   args.update_golden, args.report) else 1)
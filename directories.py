@@ -1,2 +1,3 @@
 base_dir = "FSL-2410"
 output_dir = "iFly-2410"
+snapshot_dir = f"{base_dir}.snapshot"  # cache of parsed csv tables, empty to disable
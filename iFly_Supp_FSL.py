@@ -1,513 +1,1942 @@
-import math
+import argparse
+import copy
+import hashlib
+import json
+import multiprocessing
 import os
+import queue
 import shutil
+import sqlite3
+import sys
+import threading
+import time
+import tracemalloc
+import warnings
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import cached_property
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from itertools import islice
+from typing import NamedTuple
+from urllib.parse import parse_qs, urlparse
 from zipfile import ZIP_DEFLATED, ZipFile
 
+import numpy as np
 import pandas as pd
 
-from directories import base_dir, output_dir
+from directories import base_dir, output_dir, snapshot_dir
 
-DF_APT = pd.read_csv(f"{base_dir}/AIRPORT.csv")
-DF_RWY = pd.read_csv(f"{base_dir}/RUNWAY.csv")
-DF_PRO = pd.read_csv(f"{base_dir}/AIRPORT_PROCEDURE.csv")
-DF_WPT = pd.read_csv(f"{base_dir}/WAYPOINT.csv")
-DF_VHF = pd.read_csv(f"{base_dir}/VHF_NAVAID.csv")
-DF_NDB = pd.read_csv(f"{base_dir}/NDB_NAVAID.csv")
+FSL_SCHEMA = {  # table: {column: dtype}, only the columns used in conversion
+    'AIRPORT': {
+        'ARPT_IDENT': str,
+        'ARPT_LAT': 'float64',
+        'ARPT_LON': 'float64',
+        'ARPT_ELEV': 'float64',
+        'TRANSITIONS_ALT': 'float64',
+        'TRANSITION_LEVEL': 'float64',
+    },
+    'RUNWAY': {
+        'ARPT_IDENT': str,
+        'RUNWAY_IDENT': str,
+        'RUNWAY_LAT': 'float64',
+        'RUNWAY_LON': 'float64',
+    },
+    'AIRPORT_PROCEDURE': {
+        'ARPT_IDENT': str,
+        'SUBS_CODE': 'category',
+        'PROC_IDENT': str,
+        'ROUTE_TYPE': 'category',
+        'TRANSITION_IDENT': str,
+        'SEQ_NR': 'float64',
+        'FIX_IDENT': str,
+        'FIX_SECT_CODE': 'category',
+        'FIX_SUBS_CODE': 'category',
+        'WAYPOINT_DESCR_CODE': 'category',
+        'TURN_DIR': 'category',
+        'RECOMMENDED_NAVAID': str,
+        'THETA': 'float64',
+        'RHO': 'float64',
+        'MAG_COURSE': 'float64',
+        'ROUTE_DISTANCE_HOLDING_DISTANCE_OR_TIME': str,
+        'PATH_AND_TERMINATION': 'category',
+        'ALT_DESCR': 'category',
+        'ALT_1': 'float64',
+        'ALT_2': 'float64',
+        'SPEED_LIMIT': str,
+        'SPEED_LIMIT_DESCR': 'category',
+        'VERTICAL_ANGLE': 'float64',
+        'CENTER_FIX_OR_TAA_PROCEDURE_TURN_IND': str,
+        'MULTIPLE_CODE_OR_TAA_SECTOR_SECT_CODE': 'category',
+        'MULTIPLE_CODE_OR_TAA_SECTOR_SUBS_CODE': 'category',
+    },
+    'WAYPOINT': {
+        'SECT_CODE': 'category',
+        'REGION_CODE': str,
+        'WAYPOINT_IDENT': str,
+        'WAYPOINT_LAT': 'float64',
+        'WAYPOINT_LON': 'float64',
+    },
+    'VHF_NAVAID': {
+        'VOR_IDENT': str,
+        'VOR_LAT': 'float64',
+        'VOR_LON': 'float64',
+    },
+    'NDB_NAVAID': {
+        'SECT_CODE': 'category',
+        'NDB_IDENT': str,
+        'NDB_LAT': 'float64',
+        'NDB_LON': 'float64',
+    },
+}
+
+
+FIX_TABLES = {  # table: (ident, lat, lon) columns
+    'WAYPOINT': ('WAYPOINT_IDENT', 'WAYPOINT_LAT', 'WAYPOINT_LON'),
+    'VHF_NAVAID': ('VOR_IDENT', 'VOR_LAT', 'VOR_LON'),
+    'NDB_NAVAID': ('NDB_IDENT', 'NDB_LAT', 'NDB_LON'),
+}
+WRITE_THREADS = 8  # threads creating small files at once
+CSV_CHUNK_ROWS = 200000  # rows parsed at a time when filtering a table
+STREAM_MEMORY_FACTOR = 4  # memory of streamed procedure rows with their encoded legs, relative to the parsed rows
+
+PRODUCTS = ['supp', 'sid', 'star', 'app']
+
+
+class Subset(NamedTuple):
+    """airports to convert: idents starting with one of prefixes or listed in airports (all if both empty),
+    located in bbox (min_lat, min_lon, max_lat, max_lon) if set,
+    fixes are kept if referenced by their procedures or within radius_km of them"""
+    prefixes: tuple = ()
+    airports: tuple = ()
+    bbox: tuple = None
+    radius_km: float = 0
+
+    def frozen(self) -> 'Subset':
+        """the same subset with tuples for fields given as lists, so that it can be hashed and compared"""
+        return self._replace(prefixes=tuple(self.prefixes), airports=tuple(self.airports),
+                             bbox=tuple(self.bbox) if self.bbox is not None else None)
+
+    def match(self, idents: pd.Series) -> np.ndarray:
+        """airport idents selected by prefixes and airports"""
+        if not self.prefixes and not self.airports:
+            return np.ones(len(idents), dtype=bool)
+        idents = idents.astype(object)
+        return (idents.str.startswith(tuple(self.prefixes)).eq(True) | idents.isin(self.airports)).to_numpy()
+
+    def inside(self, lat: pd.Series, lon: pd.Series) -> np.ndarray:
+        """points in bbox, which may cross the antimeridian (min_lon > max_lon)"""
+        if self.bbox is None:
+            return np.ones(len(lat), dtype=bool)
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        in_lon = (lon >= min_lon) & (lon <= max_lon) if min_lon <= max_lon else (lon >= min_lon) | (lon <= max_lon)
+        return ((lat >= min_lat) & (lat <= max_lat) & in_lon).to_numpy()
+
+
+def cycle_signature(base_dir: str) -> str:
+    """changes whenever a csv file of the cycle is replaced or modified"""
+    stats = []
+    for name in FSL_SCHEMA:
+        try:
+            stat = os.stat(f"{base_dir}/{name}.csv")
+            stats.append((name, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            stats.append((name, None, None))
+    return hashlib.sha1(repr((base_dir, stats)).encode()).hexdigest()[:16]
+
+
+SHARED = {}  # shared_key: table or lookup loaded once for the cycles of a batch with the same csv content
+SHARED_TABLES = {}  # attribute of FSLDataset: csv tables it is built from
+
+
+def shared_property(*tables: str) -> cached_property:
+    """cached_property of FSLDataset taken from SHARED if a cycle with the same tables loaded it"""
+    def decorator(build):
+        SHARED_TABLES[build.__name__] = tables
+
+        def get(self):
+            key = self.shared_key(build.__name__)
+            if key in SHARED:
+                return SHARED[key]
+            return build(self)
+        get.__name__, get.__doc__ = build.__name__, build.__doc__
+        return cached_property(get)
+    return decorator
+
+
+class FSLDataset:
+    """tables of one FSL cycle and the lookups built from them, each loaded on first access,
+    restricted to the airports of subset if set, digests ({table: sha256 of its csv}) let batch cycles share them"""
+
+    def __init__(self, base_dir: str, snapshot_dir: str = '', subset: Subset = None, digests: dict = None) -> None:
+        self.base_dir = base_dir
+        self.snapshot_dir = snapshot_dir  # empty to always parse csv
+        self.subset = subset.frozen() if subset is not None else None
+        self.digests = digests
+        self.signature = cycle_signature(base_dir)  # of the csv files when the dataset was created
+
+    def shared_key(self, name: str) -> tuple:
+        """key of attribute name in SHARED, None without digests,
+        subset tables depend on the airports and procedures too"""
+        if self.digests is None:
+            return None
+        tables = SHARED_TABLES[name] if self.subset is None else sorted(FSL_SCHEMA)
+        return (name, self.subset, *(self.digests[table] for table in tables))
+
+    def read_table(self, name: str) -> pd.DataFrame:
+        """reads {base_dir}/{name}.csv with its declared schema,
+        through a pickled snapshot in snapshot_dir (if set) keyed by the csv mtime and size,
+        with a subset only its rows are kept, filtered chunk by chunk while parsing unless snapshotted"""
+        schema = FSL_SCHEMA[name]
+        csv_path = f"{self.base_dir}/{name}.csv"
+        snapshot_path = ''
+        if self.snapshot_dir:
+            stat = os.stat(csv_path)
+            key = hashlib.sha1(repr((stat.st_mtime_ns, stat.st_size, pd.__version__,
+                                     sorted((c, str(t)) for c, t in schema.items()))).encode()).hexdigest()
+            snapshot_path = f"{self.snapshot_dir}/{name}-{key[:16]}.pkl"
+        if snapshot_path and os.path.exists(snapshot_path):
+            df = pd.read_pickle(snapshot_path)
+            if self.subset is None:
+                return df
+            return df[self.subset_rows(name, df)].reset_index(drop=True)
+        if self.subset is not None:  # snapshots hold whole tables only
+            chunks = [chunk[self.subset_rows(name, chunk)] for chunk in
+                      pd.read_csv(csv_path, usecols=list(schema), dtype=schema, chunksize=CSV_CHUNK_ROWS)]
+            if not chunks:
+                return pd.read_csv(csv_path, usecols=list(schema), dtype=schema)
+            # categories differ between chunks
+            return pd.concat(chunks, ignore_index=True).astype(
+                {c: t for c, t in schema.items() if t == 'category'})
+        df = pd.read_csv(csv_path, usecols=list(schema), dtype=schema)
+        if not snapshot_path:
+            return df
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        for filename in os.listdir(self.snapshot_dir):  # outdated snapshots
+            if filename.startswith(f"{name}-") and filename.endswith(".pkl"):
+                os.remove(f"{self.snapshot_dir}/{filename}")
+        df.to_pickle(f"{snapshot_path}.tmp")
+        os.replace(f"{snapshot_path}.tmp", snapshot_path)
+        return df
+
+    def subset_rows(self, name: str, df: pd.DataFrame) -> np.ndarray:
+        """rows of a table kept by the subset"""
+        if name == 'AIRPORT':
+            return self.subset.match(df['ARPT_IDENT']) & self.subset.inside(df['ARPT_LAT'], df['ARPT_LON'])
+        if name in ['RUNWAY', 'AIRPORT_PROCEDURE']:
+            if self.subset.bbox is None:  # also airports missing from AIRPORT.csv
+                return self.subset.match(df['ARPT_IDENT'])
+            return df['ARPT_IDENT'].isin(self.apt['ARPT_IDENT']).to_numpy()
+        ident_col = FIX_TABLES[name][0]
+        keep = df[ident_col].isin(self.fix_idents).to_numpy()
+        if self.subset.radius_km > 0 and len(df):
+            index = FixIndex.of_table(name, df)
+            for arpt_lat, arpt_lon in zip(self.apt['ARPT_LAT'], self.apt['ARPT_LON']):
+                if np.isfinite(arpt_lat) and np.isfinite(arpt_lon):
+                    rows = [row for _, _, row in index.within(arpt_lat, arpt_lon, self.subset.radius_km)]
+                    keep[df.index.get_indexer(rows)] = True
+        return keep
+
+    @cached_property
+    def fix_idents(self) -> set:
+        """idents of every fix and RF center the procedures refer to, all candidates of those are kept,
+        read column by column if the procedure table is not loaded"""
+        cols = ['FIX_IDENT', 'CENTER_FIX_OR_TAA_PROCEDURE_TURN_IND']
+        if 'pro' in self.__dict__:
+            chunks = [self.pro[cols]]
+        else:
+            chunks = (chunk[self.subset_rows('AIRPORT_PROCEDURE', chunk)] for chunk in
+                      pd.read_csv(f"{self.base_dir}/AIRPORT_PROCEDURE.csv", usecols=['ARPT_IDENT'] + cols,
+                                  dtype=str, chunksize=CSV_CHUNK_ROWS))
+        idents = set()
+        for chunk in chunks:
+            idents.update(chunk[cols[0]].dropna())
+            idents.update(chunk[cols[1]].dropna().str.strip())
+        return idents
+
+    def procedure_batches(self, memory_mb: float):
+        """yields AIRPORT_PROCEDURE.csv in parts of whole airports, sized to keep the resident memory of this process
+        under memory_mb while a part is exported: the first part from an estimate, the next ones from the memory
+        the previous part took where it can be measured (Linux), else all from the estimate of memory_mb per part,
+        a part holds at least one airport, the stream record of STATS tells how it went,
+        raises ValueError if the tables kept already take memory_mb or if the file is not grouped by airport"""
+        schema = FSL_SCHEMA['AIRPORT_PROCEDURE']
+        base = current_rss_mb()
+        if base is not None and base >= memory_mb:
+            raise ValueError(f"{base:.0f} MB of tables and lookups are in use before streaming, "
+                             f"more than the ceiling of {memory_mb:g} MB")
+        STATS.stream = {'ceiling_mb': memory_mb, 'base_mb': base, 'parts': 0, 'peak_mb': base, 'over_ceiling': 0}
+        reader = pd.read_csv(f"{self.base_dir}/AIRPORT_PROCEDURE.csv", usecols=list(schema), dtype=schema,
+                             iterator=True)
+        rows = 1000  # until the size of a row is known
+        row_bytes = 0
+        pending = None
+        done = set()  # airports already yielded
+        while True:
+            start = current_rss_mb() if reset_peak_rss(keep=True) else None  # measures reading and exporting a part
+            try:
+                chunk = reader.get_chunk(rows)
+            except StopIteration:
+                chunk = None
+            if chunk is not None:
+                if self.subset is not None:
+                    chunk = chunk[self.subset_rows('AIRPORT_PROCEDURE', chunk)]
+                if not row_bytes and len(chunk):
+                    row_bytes = chunk.memory_usage(deep=True).sum() / len(chunk) * STREAM_MEMORY_FACTOR
+                    rows = max(1000, int((memory_mb - (base or 0)) * 2**20 / row_bytes / 4))  # grows once measured
+                if pending is None:
+                    pending = chunk
+                else:
+                    with warnings.catch_warnings():  # all-NA columns, their dtypes are declared by the schema
+                        warnings.simplefilter('ignore', FutureWarning)
+                        pending = pd.concat([pending, chunk], ignore_index=True)
+            if pending is None:
+                return
+            idents = pending['ARPT_IDENT'].to_numpy()
+            if chunk is None:  # end of file
+                cut = len(pending)
+            else:  # keep the last airport, it may go on in the next chunk
+                changes = np.flatnonzero(idents[1:] != idents[:-1])
+                cut = changes[-1] + 1 if len(changes) else 0
+            if cut:
+                batch = pending.iloc[:cut].reset_index(drop=True).astype(
+                    {c: t for c, t in schema.items() if t == 'category'})  # categories differ between chunks
+                airports = set(batch['ARPT_IDENT'].dropna())
+                if airports & done:
+                    raise ValueError("AIRPORT_PROCEDURE.csv is not grouped by airport, convert it without streaming")
+                done |= airports
+                pending = pending.iloc[cut:].reset_index(drop=True)
+                yield batch
+                batch = None  # released by the consumer before the next part is read
+                STATS.stream['parts'] += 1
+                if start is not None:
+                    peak = status_mb('VmHWM')
+                    STATS.stream['peak_mb'] = max(STATS.stream['peak_mb'], peak)
+                    STATS.stream['over_ceiling'] += peak > memory_mb
+                    if peak > start:  # resize to what is left under the ceiling, at most doubled
+                        row_bytes = (peak - start) * 2**20 / cut
+                        rows = max(1000, min(2 * rows, int((memory_mb - current_rss_mb()) * 2**20 / row_bytes)))
+            if chunk is None:
+                return
+
+    def release(self, *names: str) -> None:
+        """drops loaded tables or lookups, read again if used later"""
+        for name in names:
+            self.__dict__.pop(name, None)
+
+    def procedure_view(self, pro: pd.DataFrame) -> 'FSLDataset':
+        """the same cycle with pro as its procedure table, other tables and lookups are shared"""
+        view = copy.copy(self)
+        view.digests = None  # lookups of pro are its own
+        for name in ['pro', 'leg_table', 'procedure_groups', 'procedure_index']:
+            view.__dict__.pop(name, None)
+        view.__dict__['pro'] = pro
+        return view
+
+    @shared_property('AIRPORT')
+    def apt(self) -> pd.DataFrame:
+        return self.read_table('AIRPORT')
+
+    @shared_property('RUNWAY')
+    def rwy(self) -> pd.DataFrame:
+        return self.read_table('RUNWAY')
+
+    @shared_property('AIRPORT_PROCEDURE')
+    def pro(self) -> pd.DataFrame:
+        return self.read_table('AIRPORT_PROCEDURE')
+
+    @shared_property('WAYPOINT')
+    def wpt(self) -> pd.DataFrame:
+        return self.read_table('WAYPOINT')
+
+    @shared_property('VHF_NAVAID')
+    def vhf(self) -> pd.DataFrame:
+        return self.read_table('VHF_NAVAID')
+
+    @shared_property('NDB_NAVAID')
+    def ndb(self) -> pd.DataFrame:
+        return self.read_table('NDB_NAVAID')
+
+    @shared_property('AIRPORT', 'RUNWAY', 'WAYPOINT', 'VHF_NAVAID', 'NDB_NAVAID')
+    def fix_index(self) -> 'FixIndex':
+        return FixIndex(self.apt, self.rwy, self.wpt, self.vhf, self.ndb)
+
+    @shared_property('AIRPORT_PROCEDURE')
+    def leg_table(self) -> 'LegTable':
+        return LegTable(self.pro)
+
+    @shared_property('RUNWAY')
+    def runways(self) -> dict:
+        """returns {arpt: [runway idents]} in file order"""
+        return self.rwy.groupby('ARPT_IDENT', sort=False)['RUNWAY_IDENT'].agg(list).to_dict()
+
+    @cached_property
+    def procedure_index(self) -> dict:
+        """returns {subs_code: {arpt: procedures}} of procedure_groups"""
+        return {subs: dict(groups) for subs, groups in self.procedure_groups.items()}
+
+    @shared_property('AIRPORT_PROCEDURE')
+    def procedure_groups(self) -> dict:
+        """returns {subs_code: partitioned procedures} for SID (D), STAR (E) and APP (F)"""
+        return {
+            'D': partition_procedures(self.pro, 'D', ['1', '2', '3', '4', '5', '6']),
+            'E': partition_procedures(self.pro, 'E', ['3', '2', '1', '6', '5', '4']),
+            'F': partition_procedures(self.pro, 'F'),
+        }
+
+
+DATA = FSLDataset(base_dir, snapshot_dir)  # current cycle, nothing is read until used
+DF_NAMES = {'DF_APT': 'apt', 'DF_RWY': 'rwy', 'DF_PRO': 'pro',
+            'DF_WPT': 'wpt', 'DF_VHF': 'vhf', 'DF_NDB': 'ndb'}
+
+
+def __getattr__(name: str):
+    """DF_APT, DF_RWY, ... as module attributes, loaded from DATA on first access"""
+    if name in DF_NAMES:
+        return getattr(DATA, DF_NAMES[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+MANIFEST_VERSION = 1  # bump when a change in conversion invalidates earlier outputs
 
 LOG = []
+ECHO = True  # print messages as they are logged, off in worker processes
+QUIET = False  # keep per-file messages out of the console, they still go to Log.txt
+EXPORTED = "[INFO] Exported: "
+
+
+class RunStats:
+    """wall time and peak memory per stage plus counters of a conversion run,
+    worker processes collect their own and the parent merges them"""
+
+    def __init__(self) -> None:
+        self.stages = {}  # name: {'seconds': float, 'peak_rss_mb' or 'max_rss_mb': float, 'peak_traced_mb': float}
+        self.counters = Counter()  # procedures, legs, fix_lookups, files, bytes
+        self.misses = Counter()  # fix lookup misses by reason
+        self.airports = set()
+        self.stream = None  # ceiling, parts and memory of a streamed run
+
+    @contextmanager
+    def stage(self, name: str):
+        """records the stage on exit, the peak resident memory of this process during the stage where it can be reset
+        (else max_rss_mb, the highest so far), traced memory only if tracemalloc is on"""
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+        resettable = reset_peak_rss()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = {'seconds': round(time.perf_counter() - start, 3)}
+            if resettable:
+                record['peak_rss_mb'] = peak_rss_mb()
+            else:
+                record['max_rss_mb'] = max_rss_mb()
+            if tracing:
+                record['peak_traced_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+            self.stages[name] = record
+
+    def merge(self, other: 'RunStats') -> None:
+        self.counters.update(other.counters)
+        self.misses.update(other.misses)
+        self.airports |= other.airports
+
+    def report(self) -> dict:
+        return {'stages': self.stages,
+                'counters': {'airports': len(self.airports),
+                             **{k: self.counters[k] for k in ['procedures', 'legs', 'fix_lookups']},
+                             **{k: self.counters[k] for k in ['leg_blocks', 'leg_blocks_reused',
+                                                              'leg_block_bytes', 'leg_block_bytes_reused']},
+                             'lookup_misses': dict(self.misses.most_common()),
+                             **{k: self.counters[k] for k in ['files', 'bytes', 'package_bytes']}},
+                **({'stream': self.stream} if self.stream is not None else {})}
+
+
+STATS = RunStats()
+
+
+RSS_PEAK_KEPT = 0  # MB, peak before the last reset_peak_rss(keep=True)
+
+
+def reset_peak_rss(keep: bool = False) -> bool:
+    """restarts the peak resident memory of this process, False where unsupported (only Linux can),
+    keep to measure a part of a stage without losing the stage's peak"""
+    global RSS_PEAK_KEPT
+    peak = peak_rss_mb() if keep else 0
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    RSS_PEAK_KEPT = peak or 0
+    return True
+
+
+def peak_rss_mb() -> float:
+    """peak resident memory of this process since reset_peak_rss, None where unsupported"""
+    peak = status_mb('VmHWM')
+    return max(peak, RSS_PEAK_KEPT) if peak is not None else None
+
+
+def current_rss_mb() -> float:
+    """resident memory of this process, None where unsupported"""
+    return status_mb('VmRSS')
+
+
+def status_mb(field: str) -> float:
+    """a memory field of /proc/self/status (Linux), None where unsupported"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return round(int(line.split()[1]) / 2**10, 1)
+    except OSError:
+        pass
+    return None
 
 
-def main() -> None:
+def max_rss_mb() -> float:
+    """peak resident memory so far of this process and its waited-for children, None where unsupported"""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return round(peak / (2**20 if sys.platform == 'darwin' else 2**10), 1)
+
+
+def main(jobs: int = 1, incremental: bool = False, products: list = PRODUCTS,
+         package: str = 'both', quiet: bool = False, trace_memory: bool = False, subset: Subset = None,
+         stream_mb: float = 0, database: str = '') -> None:
+    convert(base_dir, output_dir, products, jobs=jobs, incremental=incremental,
+            snapshot_dir=snapshot_dir, package=package, quiet=quiet, trace_memory=trace_memory, subset=subset,
+            stream_mb=stream_mb, database=database)
+
+
+def convert(base_dir: str, output_dir: str, products: list = PRODUCTS, jobs: int = 1,
+            incremental: bool = False, snapshot_dir: str = '', package: str = 'both',
+            quiet: bool = False, trace_memory: bool = False, subset: Subset = None,
+            stream_mb: float = 0, database: str = '') -> bool:
+    """converts the FSL cycle in base_dir into output_dir and/or its zip package
+    (package: 'both', 'dir' or 'zip', incremental runs always keep output_dir),
+    products is a subset of PRODUCTS, only the airports of subset if set, returns True if completed,
+    stream_mb > 0 converts procedures a part at a time under that resident memory (not with jobs or incremental),
+    procedures and legs also go to the SQLite file database if set,
+    Log.txt and the Report.json of STATS are written to output_dir either way"""
+    global DATA, QUIET, STATS
+    if subset is not None:
+        subset = subset.frozen()
+    if (DATA.base_dir, DATA.snapshot_dir, DATA.subset, DATA.signature) != \
+            (base_dir, snapshot_dir, subset, cycle_signature(base_dir)):  # tables read before the csv changed
+        DATA = FSLDataset(base_dir, snapshot_dir, subset)
+    products = [p for p in PRODUCTS if p in products]
+    procedures = [p for p in products if p != 'supp']
+    manifest_path = f"{output_dir}.manifest.json"
+    to_dir = package != 'zip' or incremental
+    sink = None
+    completed = False
+    LOG.clear()
+    QUIET = quiet
+    STATS = RunStats()
+    started = time.perf_counter()
+    if trace_memory:
+        tracemalloc.start()
     try:
         # restore directories
         print_debug_message("[INFO] Preparing output directories...")
-        shutil.rmtree(output_dir, ignore_errors=True)
-        os.makedirs(output_dir)
-        os.makedirs(os.path.join(output_dir, "Supp"), exist_ok=True)
-        os.makedirs(os.path.join(output_dir, "Star"), exist_ok=True)
-        os.makedirs(os.path.join(output_dir, "Sid"), exist_ok=True)
+        if stream_mb and (jobs > 1 or incremental):
+            raise ValueError("streaming cannot be combined with jobs or incremental")
+        with STATS.stage('load'):
+            # pro before the fix tables, a subset filters them by the fix_idents of its procedures
+            for table in ['apt'] + (['rwy'] if procedures else []) + \
+                    (['pro'] if procedures and not stream_mb else []) + \
+                    (['wpt', 'vhf', 'ndb'] if procedures else []):
+                getattr(DATA, table)
+        if procedures:
+            with STATS.stage('index'):
+                DATA.fix_index
+                DATA.runways
+                if not stream_mb:
+                    DATA.leg_table
+                    DATA.procedure_groups
+                else:  # streamed parts only need the lookups built from these, nor the whole table of an earlier run
+                    DATA.release('rwy', 'wpt', 'vhf', 'ndb', 'pro', 'leg_table', 'procedure_groups', 'procedure_index')
+        airports = None  # all
+        if incremental:
+            manifest = load_manifest(manifest_path, products)
+            if os.path.exists(manifest_path):  # stale until this run completes
+                os.remove(manifest_path)
+            fingerprints = airport_fingerprints(products)
+            if manifest is not None and os.path.isdir(output_dir):
+                airports = {a for a, fp in fingerprints.items() if manifest.get(a) != fp}
+                removed = set(manifest) - set(fingerprints)
+                for arpt in airports | removed:
+                    for filename in airport_files(arpt, products):
+                        if os.path.exists(f"{output_dir}/{filename}"):
+                            os.remove(f"{output_dir}/{filename}")
+                print_debug_message(
+                    f"[INFO] Incremental: {len(airports)} changed, {len(removed)} removed, "
+                    f"{len(fingerprints) - len(airports)} unchanged airports")
+            if airports is not None and database and not os.path.exists(database):
+                print_debug_message(f"[WARN] No database {database} to update, converting all airports")
+                airports = None
+        if airports is None:
+            shutil.rmtree(output_dir, ignore_errors=True)
+        os.makedirs(output_dir, exist_ok=True)
+        if to_dir:
+            os.makedirs(os.path.join(output_dir, "Supp"), exist_ok=True)
+            os.makedirs(os.path.join(output_dir, "Star"), exist_ok=True)
+            os.makedirs(os.path.join(output_dir, "Sid"), exist_ok=True)
+        sink = OutputSink(output_dir, to_dir,
+                          f"{output_dir}-CHN-PROC-FULL.zip" if package != 'dir' else '',
+                          database, update=airports is not None)
+        if database and airports is not None:
+            sink.database.drop(airports | removed, [kind for p in procedures for kind in [p, f"{p}trs"]])
         # convert
         print_debug_message("[INFO] Converting from FSL to iFly...")
-        export_airport_supp()
-        export_airport_sid()
-        export_airport_star()
-        export_airport_app()
+        if 'supp' in products:
+            with STATS.stage('supp'):
+                export_airport_supp(sink, airports)
+        if jobs > 1 and procedures:  # products run interleaved, timed as one stage
+            with STATS.stage('+'.join(procedures)):
+                export_airports_parallel(sink, jobs, products, airports)
+        elif stream_mb and procedures:
+            with STATS.stage('+'.join(procedures)):
+                export_airports_streamed(sink, stream_mb, products)
+        else:
+            for product, exporter in [('sid', export_airport_sid), ('star', export_airport_star),
+                                      ('app', export_airport_app)]:
+                if product in products:
+                    with STATS.stage(product):
+                        exporter(sink, airports)
+        if incremental:
+            json.dump({'version': MANIFEST_VERSION, 'products': products, 'airports': fingerprints},
+                      open(manifest_path, 'w'), indent=0, sort_keys=True)
         # pack
         print_debug_message("[INFO] Making package...")
-        shutil.copy("Installation.txt", f"{output_dir}/Installation.txt")
-        with ZipFile(f"{output_dir}-CHN-PROC-FULL.zip", 'w',
-                     compression=ZIP_DEFLATED, compresslevel=9) as zipf:
-            for root, dirs, files in os.walk(output_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, output_dir)
-                    zipf.write(file_path, arcname=arcname)
+        with STATS.stage('package'):
+            sink.write("Installation.txt", open(os.path.join(
+                os.path.dirname(os.path.abspath(__file__)), "Installation.txt"), 'rb').read())
+            sink.close()
         print_debug_message("[INFO] Completed!")
+        completed = True
+        return True
     except Exception as e:
         print_debug_message(f"[ERRO] {repr(e)}")
+        return False
     finally:
+        if sink is not None:
+            sink.abort()
+        if trace_memory:
+            tracemalloc.stop()
+        os.makedirs(output_dir, exist_ok=True)
         open(f"{output_dir}/Log.txt", 'w',
              newline='\r\n').write('\n'.join(LOG))
+        json.dump({'completed': completed, 'base_dir': base_dir, 'output_dir': output_dir,
+                   'products': products, 'jobs': jobs, 'incremental': incremental, 'package': package,
+                   'subset': subset._asdict() if subset is not None else None,
+                   'seconds': round(time.perf_counter() - started, 3),
+                   'warnings': sum(msg.startswith("[WARN]") for msg in LOG),
+                   **STATS.report()},
+                  open(f"{output_dir}/Report.json", 'w'), indent=2)
 
 
-def export_airport_supp() -> None:
-    DF_APT['TRANSITIONS_ALT'] = DF_APT['TRANSITIONS_ALT'].fillna(9800)
-    DF_APT['TRANSITION_LEVEL'] = DF_APT['TRANSITION_LEVEL'].fillna(11800)
-    for _, row in DF_APT.iterrows():
-        arpt_name = row['ARPT_IDENT']
-        lines = ["[Speed_Transition]"]
-        lines.append("Speed=250")
-        arpt_alt = int(row['ARPT_ELEV'])
-        arpt_alt = 0 if arpt_alt < 5000 else arpt_alt
-        spd_alt = int((arpt_alt+10000)/1000)*1000
-        lines.append(f"Altitude={spd_alt}")
-        lines.append("[Transition_Altitude]")
-        trs_alt = int(row['TRANSITIONS_ALT'])
-        lines.append(f"Altitude={trs_alt}")
-        lines.append("[Transition_Level]")
-        trs_lvl = int(row['TRANSITION_LEVEL'])
-        lines.append(f"Altitude={trs_lvl}")
-        open(f"{output_dir}/Supp/{arpt_name}.supp", 'w',
-             newline='\r\n').write('\n'.join(lines))
-        print_debug_message(f"[INFO] Exported: {arpt_name}.supp")
-
-
-def export_airport_sid() -> None:
-    arpt_list = DF_PRO.loc[(DF_PRO['SUBS_CODE'] == 'D') &
-                           (DF_PRO['ROUTE_TYPE'].isin(
-                               ['0', '1', '2', '3', '4', '5', '6'])),
-                           'ARPT_IDENT'].value_counts(sort=False).index.to_list()
-    for arpt in arpt_list:  # by airport
-        df_arpt_proc = DF_PRO[(DF_PRO['ARPT_IDENT'] == arpt) &
-                              # departure
-                              (DF_PRO['SUBS_CODE'] == 'D') &
-                              # RNAV SID
-                              (DF_PRO['ROUTE_TYPE'].isin(['1', '2', '3', '4', '5', '6']))]
-        # structure: {type:{procedure:[[leg,],]}}
-        dict_arpt = {'main': {}, 'trans': {}}
-        for proc_type in ['0', '1', '2', '3', '4', '5', '6']:  # force sequence
-            # by procedure
-            df_arpt_proc_type = df_arpt_proc[df_arpt_proc['ROUTE_TYPE'] == proc_type]
-            if not df_arpt_proc_type.shape[0]:
-                continue
-            for dict_proc in split_procedure(df_arpt_proc_type, 'SEQ_NR'):
-                proc_name = dict_proc['ident']
-                proc_conn = dict_proc['conn']
-                proc_legs = [extract_leg(r)
-                             for _, r in dict_proc['legs'].iterrows()]
-                if proc_type in ['3', '6']:  # SID trans
-                    dict_arpt['trans'][f"{proc_conn}.{proc_name}"] = proc_legs
-                    continue
-                arpt_rwys = DF_RWY.loc[DF_RWY['ARPT_IDENT'] == arpt,
-                                       'RUNWAY_IDENT'].to_list()
-                if pd.isna(proc_conn) or proc_conn == 'ALL':
-                    is_extended = False
-                    # find a previous procedure with same ident
-                    for pn in dict_arpt['main'].keys():
-                        if pn.split('.')[0] == proc_name:
-                            # drop first point (IF leg)
-                            dict_arpt['main'][pn].extend(proc_legs[1:])
-                            is_extended = True
-                    if is_extended:
-                        continue
-                    else:
-                        proc_conn = 'RW'  # eliminate na
-                if proc_conn[-1] == 'B':
-                    proc_conn = proc_conn[:-1]
-                for rw in arpt_rwys:  # rw is like "RW09L"
-                    if proc_conn in rw:
-                        dict_arpt['main'][f"{proc_name}.{rw[2:]}"] = proc_legs
-        # organize this airport
-        for pt in ['main', 'trans']:
-            if len(dict_arpt[pt]) == 0:
-                continue
-            full_lines = ["[list]"]
-            i = 0
-            for pn in sorted(dict_arpt[pt].keys()):
-                full_lines.append(f"Procedure.{i}={pn}")
-                i += 1
-            for pn in sorted(dict_arpt[pt].keys()):  # pn:str, pl:list
-                k = 0
-                pl = dict_arpt[pt][pn]
-                for ls in pl:  # ls:list
-                    full_lines.append(f"[{pn}.{k}]")
-                    full_lines.extend(ls)
-                    k += 1
-            filename = f"{arpt}.sid{'trs' if pt == 'trans' else ''}"
-            open(f"{output_dir}/Sid/{filename}", 'w',
-                 newline='\r\n').write('\n'.join(full_lines))
-            print_debug_message(f"[INFO] Exported: {filename}")
-
-
-def export_airport_star() -> None:
-    arpt_list = DF_PRO.loc[(DF_PRO['SUBS_CODE'] == 'E') &
-                           (DF_PRO['ROUTE_TYPE'].isin(
-                               ['3', '2', '1', '6', '5', '4'])),
-                           'ARPT_IDENT'].value_counts(sort=False).index.to_list()
-    for arpt in arpt_list:  # by airport
-        df_arpt_proc = DF_PRO[(DF_PRO['ARPT_IDENT'] == arpt) &
-                              # arrival
-                              (DF_PRO['SUBS_CODE'] == 'E') &
-                              # RNAV STAR
-                              (DF_PRO['ROUTE_TYPE'].isin(['3', '2', '1', '6', '5', '4']))]
-        # structure: {type:{procedure:[[leg,],]}}
-        dict_arpt = {'main': {}, 'trans': {}}
-        for proc_type in ['3', '2', '1', '6', '5', '4']:  # force sequence
-            # by procedure
-            df_arpt_proc_type = df_arpt_proc[df_arpt_proc['ROUTE_TYPE'] == proc_type]
-            if not df_arpt_proc_type.shape[0]:
-                continue
-            for dict_proc in split_procedure(df_arpt_proc_type, 'SEQ_NR'):
-                proc_name = dict_proc['ident']
-                proc_conn = dict_proc['conn']
-                proc_legs = [extract_leg(r)
-                             for _, r in dict_proc['legs'].iterrows()]
-                if proc_type in ['1', '4']:  # STAR trans
-                    dict_arpt['trans'][f"{proc_conn}.{proc_name}"] = proc_legs
-                    continue
-                arpt_rwys = DF_RWY.loc[DF_RWY['ARPT_IDENT'] == arpt,
-                                       'RUNWAY_IDENT'].to_list()
-                if pd.isna(proc_conn) or proc_conn == 'ALL':
-                    is_extended = False
-                    # find a previous procedure with same ident
-                    for pn in dict_arpt['main'].keys():
-                        if pn.split('.')[0] == proc_name:
-                            # drop first point (IF leg), reversed extend
-                            plegs = list(proc_legs)  # copy by val
-                            plegs.extend(dict_arpt['main'][pn][1:])
-                            dict_arpt['main'][pn] = plegs
-                            is_extended = True
-                    if is_extended:
-                        continue
-                    else:
-                        proc_conn = 'RW'  # eliminate na
-                if proc_conn[-1] == 'B':
-                    proc_conn = proc_conn[:-1]
-                for rw in arpt_rwys:  # rw is like "RW09L"
-                    if proc_conn in rw:
-                        dict_arpt['main'][f"{proc_name}.{rw[2:]}"] = proc_legs
-        # organize this airport
-        for pt in ['main', 'trans']:
-            if len(dict_arpt[pt]) == 0:
-                continue
-            full_lines = ["[list]"]
-            i = 0
-            for pn in sorted(dict_arpt[pt].keys()):
-                full_lines.append(f"Procedure.{i}={pn}")
-                i += 1
-            for pn in sorted(dict_arpt[pt].keys()):  # pn:str, pl:list
-                k = 0
-                pl = dict_arpt[pt][pn]
-                for ls in pl:  # ls:list
-                    full_lines.append(f"[{pn}.{k}]")
-                    full_lines.extend(ls)
-                    k += 1
-            filename = f"{arpt}.star{'trs' if pt == 'trans' else ''}"
-            open(f"{output_dir}/Star/{filename}", 'w',
-                 newline='\r\n').write('\n'.join(full_lines))
-            print_debug_message(f"[INFO] Exported: {filename}")
-
-
-def export_airport_app() -> None:
-    arpt_list = DF_PRO.loc[DF_PRO['SUBS_CODE'] == 'F',
-                           'ARPT_IDENT'].value_counts(sort=False).index.to_list()
-    for arpt in arpt_list:  # by airport
-        df_arpt_proc = DF_PRO[(DF_PRO['ARPT_IDENT'] == arpt) &
-                              (DF_PRO['SUBS_CODE'] == 'F')]  # approach
-        # structure: {type:{procedure:[[leg,],]}}
-        dict_arpt = {'main': {}, 'trans': {}}
-        # by procedure
-        for dict_proc in split_procedure(df_arpt_proc, 'SEQ_NR'):
-            proc_name = dict_proc['ident']
-            proc_conn = dict_proc['conn']
-            proc_type = dict_proc['type']
-            proc_legs = [extract_leg(r)
-                         for _, r in dict_proc['legs'].iterrows()]
-            if proc_type == 'A':  # approach trans
-                dict_arpt['trans'][f"{proc_conn}.{proc_name}"] = proc_legs
-            else:  # approach, need to parse runway ident from procedure ident
-                rw_ident = str(proc_name[1:3])
-                if rw_ident.isdigit():
-                    if len(proc_name) > 3:  # contains L/R and/or W/X/Y/Z
-                        rw_ident += proc_name[3] if proc_name[3] in ['L', 'R'] else ""
-                    dict_arpt['main'][f"{proc_name}.{rw_ident}"] = proc_legs
-                else:  # in case not specified, e.g. ZYJM:CNDB
-                    arpt_rwys = DF_RWY.loc[DF_RWY['ARPT_IDENT'] == arpt,
-                                           'RUNWAY_IDENT'].to_list()
-                    for rw in arpt_rwys:  # rw is like "RW09L"
-                        dict_arpt['main'][f"{proc_name}.{rw[2:]}"] = proc_legs
-                        print_debug_message(
-                            f"[WARN] uncertain runway, added to all. {arpt}:{proc_name}:{proc_conn}")
-        # organize this airport
-        for pt in ['main', 'trans']:
-            if len(dict_arpt[pt]) == 0:
+def csv_digest(path: str) -> str:
+    """sha256 of a csv file's content"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def batch(cycles: list, workers: int = 0, snapshot: bool = False, database: bool = False,
+          report_path: str = '', **options) -> bool:
+    """converts every (base_dir, output_dir) of cycles with convert(**options), workers cycles at once
+    (default: one per cycle up to the cpu count, in turn where processes cannot be forked),
+    tables and lookups whose csv content is the same in several cycles are loaded once before and shared,
+    each cycle gets its own package, Log.txt and Report.json (and {base_dir}.snapshot, {output_dir}.sqlite),
+    a combined summary is printed and written to report_path if set, returns True if all completed"""
+    global DATA
+    started = time.perf_counter()
+    print_debug_message(f"[INFO] Hashing tables of {len(cycles)} cycles...")
+    with ThreadPoolExecutor(WRITE_THREADS) as pool:
+        digests = [dict(zip(FSL_SCHEMA, pool.map(csv_digest, [f"{base}/{name}.csv" for name in FSL_SCHEMA])))
+                   for base, _ in cycles]
+    hashed = time.perf_counter()
+    datasets = [FSLDataset(base, f"{base}.snapshot" if snapshot else '', options.get('subset'), digest)
+                for (base, _), digest in zip(cycles, digests)]
+    # what convert loads before exporting
+    products = options.get('products', PRODUCTS)
+    attrs = ['apt']
+    if any(p != 'supp' for p in products):
+        streamed = bool(options.get('stream_mb'))
+        attrs += ['rwy'] + (['pro'] if not streamed else []) + ['wpt', 'vhf', 'ndb', 'fix_index', 'runways']
+        if not streamed:
+            attrs += ['leg_table', 'procedure_groups']
+    uses = Counter(dataset.shared_key(attr) for dataset in datasets for attr in attrs)
+    print_debug_message(f"[INFO] Loading {sum(n > 1 for n in uses.values())} shared tables and lookups...")
+    for dataset in datasets:
+        for attr in attrs:
+            key = dataset.shared_key(attr)
+            if uses[key] > 1 and key not in SHARED:
+                SHARED[key] = getattr(dataset, attr)
+    loaded = time.perf_counter()
+    tasks = [(dataset, output, f"{output}.sqlite" if database else '', options)
+             for dataset, (_, output) in zip(datasets, cycles)]
+    workers = workers or min(len(cycles), os.cpu_count() or 1)
+    results = []
+    pool = None
+    try:
+        if workers > 1 and 'fork' in multiprocessing.get_all_start_methods():  # workers inherit SHARED
+            pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork'))
+            runs = pool.map(batch_task, tasks)
+        else:
+            runs = (batch_task(task, echo=ECHO) for task in tasks)
+        for (base, output), (completed, seconds) in zip(cycles, runs):
+            print_debug_message(f"[{'INFO' if completed else 'ERRO'}] {base} -> {output}: "
+                                f"{'completed' if completed else 'failed'} in {seconds:.1f} s")
+            results.append(completed)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        SHARED.clear()
+        DATA = FSLDataset(base_dir, snapshot_dir)
+    summary = {'cycles': [], 'workers': workers, 'hash_seconds': round(hashed - started, 3),
+               'shared_seconds': round(loaded - hashed, 3),
+               'shared': {attr: sum(uses[dataset.shared_key(attr)] > 1 for dataset in datasets) for attr in attrs},
+               'seconds': round(time.perf_counter() - started, 3)}
+    for (base, output), completed in zip(cycles, results):
+        report = json.load(open(f"{output}/Report.json"))
+        summary['cycles'].append({'base_dir': base, 'output_dir': output, 'completed': completed,
+                                  'seconds': report['seconds'], 'warnings': report['warnings'],
+                                  'stages': {stage: times['seconds'] for stage, times in report['stages'].items()}})
+    if ECHO:
+        print(f"{'cycle':<32} {'seconds':>8}  stages")
+        for cycle in summary['cycles']:
+            stages = ' '.join(f"{stage}={seconds:.2f}" for stage, seconds in cycle['stages'].items())
+            print(f"{cycle['output_dir']:<32} {cycle['seconds']:>8.2f}  {stages}")
+        print(f"{'total':<32} {summary['seconds']:>8.2f}  hash={summary['hash_seconds']:.2f} "
+              f"shared={summary['shared_seconds']:.2f} workers={workers}")
+    if report_path:
+        json.dump(summary, open(report_path, 'w'), indent=2)
+    return all(results)
+
+
+def batch_task(task: tuple, echo: bool = False) -> tuple:
+    """converts one cycle of a batch, messages are printed if echo, returns (completed, seconds)"""
+    global DATA, ECHO
+    dataset, output, database, options = task
+    DATA = dataset  # kept by convert, its shared lookups with it
+    echo, ECHO = ECHO, echo
+    started = time.perf_counter()
+    try:
+        completed = convert(dataset.base_dir, output, snapshot_dir=dataset.snapshot_dir, database=database, **options)
+    finally:
+        ECHO = echo
+    return completed, time.perf_counter() - started
+
+
+class OutputSink:
+    """destination of the generated files: the output_dir tree, the zip package or both,
+    zip entries are compressed by a background thread while conversion goes on"""
+
+    def __init__(self, output_dir: str, to_dir: bool = True, zip_path: str = '', database: str = '',
+                 update: bool = False) -> None:
+        self.output_dir = output_dir
+        self.to_dir = to_dir
+        self.zip_path = zip_path
+        self.written = set()
+        self.database = ProcedureDatabase(database, update) if database else None
+        self.records = self.database is not None  # exporters pass procedure records too
+        self._zip = None
+        if zip_path:  # built aside, replaces zip_path once complete
+            self._zip = ZipFile(f"{zip_path}.tmp", 'w', compression=ZIP_DEFLATED, compresslevel=9)
+            self._queue = queue.Queue(maxsize=1024)
+            self._error = None
+            self._thread = threading.Thread(target=self._compress, daemon=True)
+            self._thread.start()
+
+    def write(self, name: str, content) -> None:
+        """name is relative to output_dir with '/' separators,
+        text content is written with CRLF line endings, bytes as is"""
+        if isinstance(content, str):
+            content = content.replace('\n', '\r\n').encode()
+        if self.to_dir:
+            self._write_file(name, content)
+        self._add(name, content)
+
+    def write_many(self, files) -> None:
+        """write of many small (name, content) files, created in output_dir by a pool of threads"""
+        files = [(name, content.replace('\n', '\r\n').encode() if isinstance(content, str) else content)
+                 for name, content in files]
+        if self.to_dir:
+            with ThreadPoolExecutor(WRITE_THREADS) as pool:
+                for _ in pool.map(lambda file: self._write_file(*file), files):
+                    pass
+        for name, content in files:
+            self._add(name, content)
+
+    def _write_file(self, name: str, content: bytes) -> None:
+        with open(os.path.join(self.output_dir, name), 'wb') as f:
+            f.write(content)
+
+    def _add(self, name: str, content: bytes) -> None:
+        STATS.counters['files'] += 1
+        STATS.counters['bytes'] += len(content)
+        if self._zip is not None:
+            self._queue.put((name, content))
+        self.written.add(name)
+
+    def _compress(self) -> None:
+        while (item := self._queue.get()) is not None:
+            if self._error is None:
+                try:
+                    self._zip.writestr(*item)
+                except Exception as e:  # raised again by close
+                    self._error = e
+
+    def add_records(self, records: list) -> None:
+        self.database.add(records)
+
+    def close(self) -> None:
+        """completes the database and the zip package, including files left in output_dir by earlier runs"""
+        if self.database is not None:
+            self.database.close()
+            self.database = None
+        if self._zip is None:
+            return
+        if self.to_dir:
+            for root, dirs, files in os.walk(self.output_dir):
+                for file in files:
+                    file_path = os.path.join(root, file)
+                    name = os.path.relpath(file_path, self.output_dir).replace(os.sep, '/')
+                    if name not in self.written and name not in ["Log.txt", "Report.json"]:
+                        self._queue.put((name, open(file_path, 'rb').read()))
+        self._finish()
+        if self._error is not None:
+            os.remove(f"{self.zip_path}.tmp")
+            raise self._error
+        os.replace(f"{self.zip_path}.tmp", self.zip_path)
+        STATS.counters['package_bytes'] = os.path.getsize(self.zip_path)
+
+    def abort(self) -> None:
+        """drops an unfinished database and zip package"""
+        if self.database is not None:
+            self.database.abort()
+            self.database = None
+        if self._zip is not None:
+            self._finish()
+            os.remove(f"{self.zip_path}.tmp")
+
+    def _finish(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+        self._zip.close()
+        self._zip = None
+
+
+class BufferSink:
+    """collects generated files (and procedure records if records) in memory, replayed into an OutputSink later"""
+
+    def __init__(self, records: bool = False) -> None:
+        self.files = []
+        self.records = records
+        self.procedures = []
+
+    def add_records(self, records: list) -> None:
+        self.procedures.extend(records)
+
+    def write(self, name: str, content) -> None:
+        self.files.append((name, content))
+
+    def write_many(self, files) -> None:
+        self.files.extend(files)
+
+
+DATABASE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS procedures (
+    id INTEGER PRIMARY KEY,
+    airport TEXT NOT NULL,
+    kind TEXT NOT NULL,  -- file extension: sid, sidtrs, star, startrs, app, apptrs
+    file TEXT NOT NULL,
+    position INTEGER NOT NULL,  -- Procedure.<position> in file
+    name TEXT NOT NULL,
+    ident TEXT,
+    runway TEXT,
+    transition TEXT
+);
+CREATE TABLE IF NOT EXISTS legs (
+    procedure_id INTEGER NOT NULL REFERENCES procedures (id),
+    seq INTEGER NOT NULL,  -- [<name>.<seq>] in file
+    leg_type TEXT,
+    fix TEXT,
+    latitude REAL,
+    longitude REAL,
+    center_fix TEXT,
+    center_lat REAL,
+    center_lon REAL,
+    text TEXT NOT NULL,  -- lines of the leg in file
+    PRIMARY KEY (procedure_id, seq)
+) WITHOUT ROWID;
+"""
+DATABASE_INDEXES = """
+CREATE INDEX IF NOT EXISTS procedures_airport ON procedures (airport, kind);
+CREATE INDEX IF NOT EXISTS procedures_ident ON procedures (ident);
+CREATE INDEX IF NOT EXISTS procedures_runway ON procedures (runway);
+CREATE INDEX IF NOT EXISTS legs_fix ON legs (fix);
+"""
+
+
+class ProcedureDatabase:
+    """procedures and legs of the exported files in SQLite, inserted in one transaction into a copy
+    built aside (of the earlier database if update), indexed and moved in place once complete"""
+
+    def __init__(self, path: str, update: bool = False) -> None:
+        self.path = path
+        if os.path.exists(f"{path}.tmp"):
+            os.remove(f"{path}.tmp")
+        if update and os.path.exists(path):
+            shutil.copyfile(path, f"{path}.tmp")
+        self._db = sqlite3.connect(f"{path}.tmp")
+        self._db.execute("PRAGMA journal_mode = OFF")  # the copy is dropped on failure
+        self._db.execute("PRAGMA synchronous = OFF")
+        self._db.executescript(DATABASE_SCHEMA)
+        self._next_id = (self._db.execute("SELECT MAX(id) FROM procedures").fetchone()[0] or 0) + 1
+
+    def drop(self, airports: set, kinds: list) -> None:
+        """removes the procedures of airports exported again"""
+        keys = [(arpt, kind) for arpt in sorted(airports) for kind in kinds]
+        self._db.executemany("DELETE FROM legs WHERE procedure_id IN "
+                             "(SELECT id FROM procedures WHERE airport = ? AND kind = ?)", keys)
+        self._db.executemany("DELETE FROM procedures WHERE airport = ? AND kind = ?", keys)
+
+    def add(self, records: list) -> None:
+        """records are (airport, kind, file, position, name, ident, runway, transition, [leg rows])"""
+        procedures, legs = [], []
+        for *procedure, leg_rows in records:
+            procedures.append((self._next_id, *procedure))
+            legs.extend((self._next_id, *leg) for leg in leg_rows)
+            self._next_id += 1
+        self._db.executemany("INSERT INTO procedures VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", procedures)
+        self._db.executemany("INSERT INTO legs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", legs)
+
+    def close(self) -> None:
+        self._db.executescript(DATABASE_INDEXES)  # commits
+        self._db.close()
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def abort(self) -> None:
+        self._db.close()
+        os.remove(f"{self.path}.tmp")
+
+
+def load_manifest(path: str, products: list) -> dict:
+    """returns {arpt: fingerprint} of the previous incremental run of the same products, None if unusable"""
+    try:
+        manifest = json.load(open(path))
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('products') != products:
+        return None
+    return manifest['airports']
+
+
+def airport_fingerprints(products: list) -> dict:
+    """returns {arpt: digest} over the rows of each airport in the tables the products use,
+    for procedures including all candidates of the fixes they reference"""
+    hashes = {}
+    tables = [('APT', DATA.apt)]
+    if set(products) - {'supp'}:
+        tables += [('RWY', DATA.rwy), ('PRO', DATA.pro)]
+    for name, df in tables:
+        row_hash = pd.util.hash_pandas_object(df, index=False).to_numpy()
+        for arpt, rows in df.groupby('ARPT_IDENT', sort=False).indices.items():
+            h = hashes.setdefault(arpt, hashlib.sha1())
+            h.update(name.encode())
+            h.update(row_hash[rows].tobytes())
+    if not set(products) - {'supp'}:
+        return {arpt: h.hexdigest() for arpt, h in hashes.items()}
+    # waypoints and navaids, runways are covered above
+    index, legs = DATA.fix_index, DATA.leg_table
+    refs = {}
+    for arpt, leg_type, pt_name, sect_code, subs_code, pt_cfix, cfix_sect, cfix_subs in zip(
+            legs.arpt, legs.leg_type, legs.pt_name, legs.fix_sect, legs.fix_subs,
+            legs.cfix, legs.cfix_sect, legs.cfix_subs):
+        points = [(pt_name, sect_code, subs_code)]
+        if leg_type == 'RF' and isinstance(pt_cfix, str):
+            points.append((pt_cfix.strip(), cfix_sect, cfix_subs))
+        for ident, sect_code, subs_code in points:
+            sect = fix_section(sect_code, subs_code)
+            if pd.isna(ident) or sect in ['', 'PG']:
                 continue
-            full_lines = ["[list]"]
-            i = 0
-            for pn in sorted(dict_arpt[pt].keys()):
-                full_lines.append(f"Procedure.{i}={pn}")
-                i += 1
-            for pn in sorted(dict_arpt[pt].keys()):  # pn:str, pl:list
-                k = 0
-                pl = dict_arpt[pt][pn]
-                for ls in pl:  # ls:list
-                    full_lines.append(f"[{pn}.{k}]")
-                    full_lines.extend(ls)
-                    k += 1
-            filename = f"{arpt}.app{'trs' if pt == 'trans' else ''}"
-            open(f"{output_dir}/Star/{filename}", 'w',
-                 newline='\r\n').write('\n'.join(full_lines))
-            print_debug_message(f"[INFO] Exported: {filename}")
-
-
-def split_procedure(df: pd.DataFrame, col: str) -> dict:
-    """return a dict of split DataFrame, structure: [{'ident':str, 'type':str , 'conn':str, 'legs': DataFrame}]"""
-    df.reset_index(drop=True, inplace=True)
-    split_indices = df[df[col].shift(1) >= df[col]].index
-    split_dataframes = []
-    start_index = 0
-    for end_index in split_indices:
-        if end_index < 1:
+            refs.setdefault(arpt, set()).add((sect, ident, arpt if sect == 'PC' else None))
+    for arpt, keys in refs.items():
+        h = hashes[arpt]
+        for key in sorted(keys, key=repr):
+            start, stop = index.slices.get(key, (0, 0))
+            h.update(repr(key).encode())
+            h.update(index.lat[start:stop].tobytes())
+            h.update(index.lon[start:stop].tobytes())
+    return {arpt: h.hexdigest() for arpt, h in hashes.items()}
+
+
+def airport_files(arpt: str, products: list = PRODUCTS) -> list:
+    """all output files an airport may have for products, relative to output_dir"""
+    files = {'supp': [f"Supp/{arpt}.supp"],
+             'sid': [f"Sid/{arpt}.sid", f"Sid/{arpt}.sidtrs"],
+             'star': [f"Star/{arpt}.star", f"Star/{arpt}.startrs"],
+             'app': [f"Star/{arpt}.app", f"Star/{arpt}.apptrs"]}
+    return [f for p in products for f in files[p]]
+
+
+def convert_airport(arpt: str, products: list = PRODUCTS) -> tuple:
+    """returns (files, messages) of one airport of DATA, files as [(name, text)] with LF line endings"""
+    global LOG, STATS
+    log, stats = LOG, STATS
+    LOG, STATS = [], RunStats()
+    sink = BufferSink()
+    try:
+        if 'supp' in products:
+            export_airport_supp(sink, {arpt})
+        for product, subs, exporter in [('sid', 'D', export_sid), ('star', 'E', export_star), ('app', 'F', export_app)]:
+            if product in products and arpt in DATA.procedure_index[subs]:
+                exporter(sink, arpt, DATA.procedure_index[subs][arpt])
+        return (sink.files, LOG)
+    finally:
+        LOG, STATS = log, stats
+
+
+class ConverterService:
+    """keeps a cycle loaded and converts single airports on demand, results are kept in an LRU cache
+    keyed by airport, products and cycle signature, the cycle is reloaded when its csv files change"""
+
+    def __init__(self, base_dir: str, output_dir: str = '', snapshot_dir: str = '', cache_size: int = 256) -> None:
+        self.base_dir = base_dir
+        self.output_dir = output_dir  # where write requests go, empty to refuse them
+        self.snapshot_dir = snapshot_dir
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # (arpt, products, signature): (files, messages)
+        self.hits = self.misses = self.reloads = 0
+        self.signature = None
+        self.refresh()
+
+    def refresh(self) -> None:
+        """loads the cycle and builds every lookup if its files changed since the last load"""
+        global DATA
+        signature = cycle_signature(self.base_dir)
+        if signature == self.signature:
+            return
+        DATA = FSLDataset(self.base_dir, self.snapshot_dir)
+        DATA.apt
+        DATA.fix_index
+        DATA.leg_table
+        DATA.runways
+        DATA.procedure_index
+        self.cache.clear()
+        self.signature = signature
+        self.reloads += 1
+
+    def convert(self, arpt: str, products: list, write: bool = False) -> dict:
+        """returns {'airport', 'cycle', 'cached', 'files': {name: text}, 'messages'},
+        files have CRLF line endings as in output_dir, written there if write"""
+        self.refresh()
+        products = [p for p in PRODUCTS if p in products]
+        key = (arpt, tuple(products), self.signature)
+        cached = key in self.cache
+        if cached:
+            self.cache.move_to_end(key)
+            self.hits += 1
+        else:
+            self.cache[key] = convert_airport(arpt, products)
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            self.misses += 1
+        files, messages = self.cache[key]
+        if write:
+            for filename in airport_files(arpt, products):
+                if os.path.exists(f"{self.output_dir}/{filename}"):
+                    os.remove(f"{self.output_dir}/{filename}")
+            for folder in ["Supp", "Star", "Sid"]:
+                os.makedirs(os.path.join(self.output_dir, folder), exist_ok=True)
+            sink = OutputSink(self.output_dir)
+            for name, content in files:
+                sink.write(name, content)
+        return {'airport': arpt, 'cycle': self.signature, 'cached': cached,
+                'files': {name: content.replace('\n', '\r\n') for name, content in files},
+                'messages': messages}
+
+    def status(self) -> dict:
+        return {'base_dir': self.base_dir, 'cycle': self.signature, 'airports': len(DATA.fix_index.airports),
+                'cache': {'size': len(self.cache), 'capacity': self.cache_size, 'hits': self.hits,
+                          'misses': self.misses}, 'reloads': self.reloads}
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """GET /airport/ZBAA?products=sid,star[&write=1] and GET /status, answers in JSON"""
+
+    def do_GET(self) -> None:
+        service = self.server.service
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = url.path.strip('/').split('/')
+        start = time.perf_counter()
+        try:
+            if parts == ['status']:
+                code, body = 200, service.status()
+            elif len(parts) == 2 and parts[0] == 'airport' and parts[1]:
+                products = ','.join(query.get('products', PRODUCTS)).split(',')
+                write = query.get('write', ['0'])[0] == '1'
+                if set(products) - set(PRODUCTS):
+                    code, body = 400, {'error': f"products must be among {PRODUCTS}"}
+                elif write and not service.output_dir:
+                    code, body = 400, {'error': "no output directory to write to"}
+                else:
+                    body = service.convert(parts[1].upper(), products, write)
+                    code = 200 if body['files'] else 404
+            else:
+                code, body = 404, {'error': "use /airport/<ICAO>?products=sid,star,app,supp or /status"}
+        except Exception as e:
+            code, body = 500, {'error': repr(e)}
+        body['ms'] = round((time.perf_counter() - start) * 1000, 2)
+        content = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def serve(base_dir: str, output_dir: str = '', port: int = 8424, snapshot_dir: str = '',
+          cache_size: int = 256) -> None:
+    """runs the converter service on localhost until interrupted, one request at a time"""
+    global ECHO
+    ECHO = False
+    server = HTTPServer(('127.0.0.1', port), ServiceHandler)
+    server.service = ConverterService(base_dir, output_dir, snapshot_dir, cache_size)
+    print(f"[INFO] Serving {base_dir} on http://127.0.0.1:{port}/airport/<ICAO>")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def export_airport_supp(sink: OutputSink, airports: set = None) -> None:
+    """all supp files computed column by column and written in one batch, DATA.apt is left as is"""
+    df_apt = DATA.apt
+    if airports is not None:
+        df_apt = df_apt[df_apt['ARPT_IDENT'].isin(airports)]
+    arpt_name = df_apt['ARPT_IDENT'].astype(str)
+    arpt_alt = df_apt['ARPT_ELEV'].astype('int64')  # raises on missing elevation
+    arpt_alt = arpt_alt.where(arpt_alt >= 5000, 0)
+    spd_alt = (arpt_alt + 10000) // 1000 * 1000
+    trs_alt = df_apt['TRANSITIONS_ALT'].fillna(9800).astype('int64')
+    trs_lvl = df_apt['TRANSITION_LEVEL'].fillna(11800).astype('int64')
+    text = ("[Speed_Transition]\nSpeed=250\nAltitude=" + spd_alt.astype(str) +
+            "\n[Transition_Altitude]\nAltitude=" + trs_alt.astype(str) +
+            "\n[Transition_Level]\nAltitude=" + trs_lvl.astype(str))
+    sink.write_many(zip(("Supp/" + arpt_name + ".supp").to_list(), text.to_list()))
+    for name in arpt_name:
+        print_debug_message(f"{EXPORTED}{name}.supp")
+    STATS.airports.update(arpt_name)
+
+
+def export_airport_sid(sink: OutputSink, airports: set = None) -> None:
+    for arpt, procs in DATA.procedure_groups['D']:  # by airport
+        if airports is None or arpt in airports:
+            export_sid(sink, arpt, procs)
+
+
+def export_sid(sink: OutputSink, arpt: str, procs: list) -> None:
+    # structure: {type:{procedure:[Leg,]}}
+    STATS.airports.add(arpt)
+    STATS.counters['procedures'] += len(procs)
+    routes = RouteAssembler(DATA.runways.get(arpt, []), prepend=False)
+    dict_arpt = {'main': routes.main, 'trans': {}}
+    for proc in procs:  # by procedure, in forced type sequence
+        proc_legs = [extract_leg(pos) for pos in proc.legs]
+        if proc.type in ['3', '6']:  # SID trans
+            dict_arpt['trans'][f"{proc.conn}.{proc.ident}"] = proc_legs
+        else:
+            routes.add(proc.ident, proc.conn, proc_legs)
+    # organize this airport, legs shared by keys are rendered once
+    blocks = LegBlocks()
+    for pt in ['main', 'trans']:
+        if len(dict_arpt[pt]) == 0:
+            continue
+        filename = f"{arpt}.sid{'trs' if pt == 'trans' else ''}"
+        write_procedures(sink, arpt, f"Sid/{filename}", dict_arpt[pt], blocks)
+        print_debug_message(f"{EXPORTED}{filename}")
+
+
+def export_airport_star(sink: OutputSink, airports: set = None) -> None:
+    for arpt, procs in DATA.procedure_groups['E']:  # by airport
+        if airports is None or arpt in airports:
+            export_star(sink, arpt, procs)
+
+
+def export_star(sink: OutputSink, arpt: str, procs: list) -> None:
+    # structure: {type:{procedure:[Leg,]}}
+    STATS.airports.add(arpt)
+    STATS.counters['procedures'] += len(procs)
+    routes = RouteAssembler(DATA.runways.get(arpt, []), prepend=True)
+    dict_arpt = {'main': routes.main, 'trans': {}}
+    for proc in procs:  # by procedure, in forced type sequence
+        proc_legs = [extract_leg(pos) for pos in proc.legs]
+        if proc.type in ['1', '4']:  # STAR trans
+            dict_arpt['trans'][f"{proc.conn}.{proc.ident}"] = proc_legs
+        else:
+            routes.add(proc.ident, proc.conn, proc_legs)
+    # organize this airport, legs shared by keys are rendered once
+    blocks = LegBlocks()
+    for pt in ['main', 'trans']:
+        if len(dict_arpt[pt]) == 0:
+            continue
+        filename = f"{arpt}.star{'trs' if pt == 'trans' else ''}"
+        write_procedures(sink, arpt, f"Star/{filename}", dict_arpt[pt], blocks)
+        print_debug_message(f"{EXPORTED}{filename}")
+
+
+def export_airport_app(sink: OutputSink, airports: set = None) -> None:
+    for arpt, procs in DATA.procedure_groups['F']:  # by airport
+        if airports is None or arpt in airports:
+            export_app(sink, arpt, procs)
+
+
+def export_app(sink: OutputSink, arpt: str, procs: list) -> None:
+    # structure: {type:{procedure:[Leg,]}}
+    STATS.airports.add(arpt)
+    STATS.counters['procedures'] += len(procs)
+    dict_arpt = {'main': {}, 'trans': {}}
+    for proc in procs:  # by procedure
+        proc_name = proc.ident
+        proc_conn = proc.conn
+        proc_type = proc.type
+        proc_legs = [extract_leg(pos) for pos in proc.legs]
+        if proc_type == 'A':  # approach trans
+            dict_arpt['trans'][f"{proc_conn}.{proc_name}"] = proc_legs
+        else:  # approach, need to parse runway ident from procedure ident
+            rw_ident = str(proc_name[1:3])
+            if rw_ident.isdigit():
+                if len(proc_name) > 3:  # contains L/R and/or W/X/Y/Z
+                    rw_ident += proc_name[3] if proc_name[3] in ['L', 'R'] else ""
+                dict_arpt['main'][f"{proc_name}.{rw_ident}"] = proc_legs
+            else:  # in case not specified, e.g. ZYJM:CNDB
+                for rw in DATA.runways.get(arpt, []):  # rw is like "RW09L"
+                    dict_arpt['main'][f"{proc_name}.{rw[2:]}"] = proc_legs
+                    print_debug_message(
+                        f"[WARN] uncertain runway, added to all. {arpt}:{proc_name}:{proc_conn}")
+    # organize this airport, legs shared by keys are rendered once
+    blocks = LegBlocks()
+    for pt in ['main', 'trans']:
+        if len(dict_arpt[pt]) == 0:
             continue
-        group_df = df.loc[start_index:end_index-1]
-        split_dataframes.append(group_df)
-        start_index = end_index
-    last_group_df = df.loc[start_index:]
-    split_dataframes.append(last_group_df)
+        filename = f"{arpt}.app{'trs' if pt == 'trans' else ''}"
+        write_procedures(sink, arpt, f"Star/{filename}", dict_arpt[pt], blocks)
+        print_debug_message(f"{EXPORTED}{filename}")
+
+
+class RouteAssembler:
+    """attaches the runway parts and common routes of one airport's SIDs or STARs to "{ident}.{runway}" keys
+    in time linear in procedures and runways: a common route ('ALL' or no transition) is appended to
+    (SID) or prepended to (STAR) every route of the same ident, without its first (IF) leg"""
+
+    def __init__(self, runways: list, prepend: bool) -> None:
+        self.main = {}  # key: [Leg], SID keys extended by one common route share its list
+        self.prepend = prepend
+        self.keys = {}  # ident: [keys of main]
+        self.runways = {}  # every substring of a runway ident: [runways containing it]
+        for rw in runways:  # rw is like "RW09L"
+            for part in {rw[i:j] for i in range(len(rw) + 1) for j in range(i, len(rw) + 1)}:
+                self.runways.setdefault(part, []).append(rw)
+
+    def add(self, ident: str, conn: str, legs: list) -> None:
+        if pd.isna(conn) or conn == 'ALL':
+            if ident in self.keys:
+                for pn in self.keys[ident]:
+                    if self.prepend:
+                        merged = legs.copy()
+                        merged.extend(islice(self.main[pn], 1, None))
+                        self.main[pn] = merged
+                    else:
+                        self.main[pn].extend(legs[1:])
+                return
+            conn = 'RW'  # all runways
+        if conn[-1] == 'B':
+            conn = conn[:-1]
+        for rw in self.runways.get(conn, []):
+            pn = f"{ident}.{rw[2:]}"
+            if pn not in self.main:
+                self.keys.setdefault(pn.split('.')[0], []).append(pn)
+            self.main[pn] = legs
+
+
+def export_airports_parallel(sink: OutputSink, jobs: int, products: list = PRODUCTS,
+                             airports: set = None) -> None:
+    """SID, STAR and APP exports with airports sharded across worker processes,
+    files are written and messages logged in the same order as the serial run"""
+    groups = DATA.procedure_groups
+    # build lookups before fork so that workers share them
+    DATA.fix_index
+    DATA.leg_table
+    DATA.runways
+    tasks = [(subs, i, sink.records) for product, subs in [('sid', 'D'), ('star', 'E'), ('app', 'F')]
+             if product in products
+             for i, (arpt, _) in enumerate(groups[subs]) if airports is None or arpt in airports]
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:  # workers load the tables once each
+        context = multiprocessing.get_context()
+    with context.Pool(jobs, initializer=init_worker,
+                      initargs=(DATA.base_dir, DATA.snapshot_dir, DATA.subset)) as pool:
+        for msgs, files, records, stats, exc in pool.imap(export_task, tasks,
+                                                          chunksize=max(1, len(tasks) // (jobs * 16))):
+            for name, content in files:
+                sink.write(name, content)
+            if records:
+                sink.add_records(records)
+            STATS.merge(stats)
+            for msg in msgs:
+                print_debug_message(msg)
+            if exc is not None:
+                raise exc
+
+
+def export_airports_streamed(sink: OutputSink, memory_mb: float, products: list = PRODUCTS) -> None:
+    """SID, STAR and APP exports a part of AIRPORT_PROCEDURE.csv at a time, each part released when done,
+    messages of later products are held back so that they are logged in the same order as a whole table run"""
+    global DATA, LOG, ECHO
+    dataset = DATA
+    exporters = [(export_airport_sid, []), (export_airport_star, []), (export_airport_app, [])]
+    exporters = [(exporter, msgs) for (exporter, msgs), product in zip(exporters, ['sid', 'star', 'app'])
+                 if product in products]
+    log, echo = LOG, ECHO
+    try:
+        for pro in dataset.procedure_batches(memory_mb):
+            DATA = dataset.procedure_view(pro)
+            pro = None  # held by the view only
+            for i, (exporter, msgs) in enumerate(exporters):
+                if i:
+                    LOG, ECHO = msgs, False
+                try:
+                    exporter(sink)
+                finally:
+                    LOG, ECHO = log, echo
+            DATA = dataset  # the part is released before the next one is read
+    finally:
+        DATA = dataset
+    for _, msgs in exporters[1:]:
+        for msg in msgs:
+            print_debug_message(msg)
+    if STATS.stream['over_ceiling']:
+        print_debug_message(f"[WARN] Memory went over the ceiling of {memory_mb:g} MB in {STATS.stream['over_ceiling']} "
+                            f"of {STATS.stream['parts']} parts, peak {STATS.stream['peak_mb']:g} MB")
+
+
+def init_worker(base_dir: str, snapshot_dir: str, subset: Subset) -> None:
+    """points a worker process at the dataset of its parent, inherited as is when forked"""
+    global DATA, ECHO
+    if (DATA.base_dir, DATA.snapshot_dir, DATA.subset) != (base_dir, snapshot_dir, subset):
+        DATA = FSLDataset(base_dir, snapshot_dir, subset)
+    ECHO = False
+    if tracemalloc.is_tracing():  # inherited from the parent, only measured there
+        tracemalloc.stop()
+
+
+def export_task(task: tuple) -> tuple:
+    """runs in worker process, returns (messages, files, procedure records, stats, exception) of one airport"""
+    global LOG, STATS
+    subs, i, records = task
+    arpt, procs = DATA.procedure_groups[subs][i]
+    LOG = []
+    STATS = RunStats()
+    sink = BufferSink(records)
+    try:
+        {'D': export_sid, 'E': export_star, 'F': export_app}[subs](sink, arpt, procs)
+    except Exception as e:
+        return (LOG, sink.files, sink.procedures, STATS, e)
+    return (LOG, sink.files, sink.procedures, STATS, None)
+
+
+class Procedure:
+    """one procedure or transition, legs are row positions in the procedure table"""
+    __slots__ = ('ident', 'type', 'conn', 'legs')
+
+    def __init__(self, ident: str, type: str, conn: str, legs: np.ndarray) -> None:
+        self.ident = ident
+        self.type = type
+        self.conn = conn
+        self.legs = legs
+
+
+class Leg:
+    """a leg of an exported procedure with its resolved coordinates, 0 if none,
+    the other lines come from the procedure table when rendered"""
+    __slots__ = ('pos', 'lat', 'lon', 'center_lat', 'center_lon')
+
+    def __init__(self, pos: int) -> None:
+        self.pos = pos
+        self.lat = self.lon = self.center_lat = self.center_lon = 0
+
+
+def partition_procedures(df: pd.DataFrame, subs_code: str, route_types: list = None) -> list:
+    """split all procedures of a subsection in one pass, structure: [(arpt, [Procedure])]
+    airports keep their order of appearance, procedures follow route_types (file order if None),
+    a new procedure starts where SEQ_NR does not increase"""
+    mask = (df['SUBS_CODE'] == subs_code).to_numpy()
+    if route_types is not None:
+        mask &= df['ROUTE_TYPE'].isin(route_types).to_numpy()
+    pos = np.flatnonzero(mask)
+    arpt_rank = pd.factorize(df['ARPT_IDENT'].to_numpy()[pos])[0]
+    if route_types is None:
+        type_rank = np.zeros(len(pos), dtype=int)
+    else:
+        type_rank = pd.Index(route_types).get_indexer(df['ROUTE_TYPE'].to_numpy()[pos])
+    order = np.lexsort((pos, type_rank, arpt_rank))
+    rows, arpt_rank, type_rank = pos[order], arpt_rank[order], type_rank[order]
+    seq = df['SEQ_NR'].to_numpy()[rows]
+    arpt_start = np.diff(arpt_rank, prepend=-1) != 0
+    proc_start = arpt_start | (np.diff(type_rank, prepend=-1) != 0)
+    proc_start[1:] |= seq[:-1] >= seq[1:]
+    arpt_start, proc_start = np.flatnonzero(arpt_start), np.flatnonzero(proc_start)
+    proc_stop = np.append(proc_start[1:], len(rows))
+    arpt_idents = df['ARPT_IDENT'].to_numpy()[rows[arpt_start]]
+    proc_cols = [df[c].to_numpy()[rows[proc_start]]
+                 for c in ['PROC_IDENT', 'ROUTE_TYPE', 'TRANSITION_IDENT']]
     res = []
-    for sd in split_dataframes:
-        sd.reset_index(drop=True, inplace=True)
-        res.append({
-            'ident': sd['PROC_IDENT'].iloc[0],
-            'type': sd['ROUTE_TYPE'].iloc[0],
-            'conn': sd['TRANSITION_IDENT'].iloc[0],
-            'legs': sd,
-        })
+    for start, ident, route_type, conn, stop in zip(proc_start, *proc_cols, proc_stop):
+        if len(res) < len(arpt_start) and start == arpt_start[len(res)]:
+            res.append((arpt_idents[len(res)], []))
+        res[-1][1].append(Procedure(ident, route_type, conn, rows[start:stop]))
     return res
 
 
-def extract_leg(row: pd.Series) -> list:
-    """return a list of lines (without header)"""
-    arpt = row['ARPT_IDENT']
-    leg_type = row['PATH_AND_TERMINATION']
-    proc_name = row['PROC_IDENT']
-    extracted_lines = [f"Leg={leg_type}"]
-    pt_name = row['FIX_IDENT']
+def exported_rows(df: pd.DataFrame) -> pd.Series:
+    """rows of the procedures in procedure_groups: SIDs and STARs of route types 1-6, every approach"""
+    return (df['SUBS_CODE'].isin(['D', 'E']) & df['ROUTE_TYPE'].isin(['1', '2', '3', '4', '5', '6'])) | \
+        (df['SUBS_CODE'] == 'F')
+
+
+class LegTable:
+    """iFly lines and warnings of the legs of exported procedures in a procedure table, encoded column by column,
+    other rows (e.g. engine-out SIDs) get no lines as they may not be formattable"""
+
+    def __init__(self, df: pd.DataFrame) -> None:
+        exported = exported_rows(df)
+        leg_type = df['PATH_AND_TERMINATION']
+        self.arpt = df['ARPT_IDENT'].to_list()
+        self.proc_name = df['PROC_IDENT'].to_list()
+        self.leg_type = leg_type.to_list()
+        self.pt_name = df['FIX_IDENT'].to_list()
+        self.fix_sect = df['FIX_SECT_CODE'].to_list()
+        self.fix_subs = df['FIX_SUBS_CODE'].to_list()
+        self.cfix = df['CENTER_FIX_OR_TAA_PROCEDURE_TURN_IND'].to_list()
+        self.cfix_sect = df['MULTIPLE_CODE_OR_TAA_SECTOR_SECT_CODE'].to_list()
+        self.cfix_subs = df['MULTIPLE_CODE_OR_TAA_SECTOR_SUBS_CODE'].to_list()
+        self.head = ("Leg=" + leg_type.astype(str)).to_list()
+
+        def text(col: str) -> pd.Series:
+            return df[col].astype(object)
+
+        def render(mask: pd.Series, values: pd.Series, fmt) -> pd.Series:
+            res = pd.Series('', index=df.index, dtype=object)
+            mask = mask & exported
+            if mask.any():
+                res[mask] = values[mask].astype(object).map(fmt)
+            return res
+        # cross this point: by finding 'B/Y' in 2nd char of WAYPOINT_DESCR_CODE
+        pt_descr = text('WAYPOINT_DESCR_CODE')
+        descr_ok = pt_descr.str.len() == 4
+        cross = render(descr_ok & pt_descr.str[1].isin(['B', 'Y']), pt_descr,
+                       lambda v: "CrossThisPoint=1")
+        # heading
+        pt_hdg = df['MAG_COURSE']
+        hdg_legs = leg_type.isin(['PI', 'HA', 'HF', 'HM', 'FM', 'VM', 'CA', 'VA', 'CD', 'VD',
+                                  'CF', 'CI', 'VI', 'CR', 'VR', 'FA', 'FC', 'FD'])
+        hdg = render(hdg_legs & pt_hdg.notna(), pt_hdg,
+                     lambda v: "Heading=%.01f" % float(v))
+        warn_hdg = hdg_legs & pt_hdg.isna()
+        # turn direction
+        pt_tdir = df['TURN_DIR']
+        tdir_ok = pt_tdir.isin(['L', 'R'])
+        tdir = render(tdir_ok, pt_tdir, lambda v: f"TurnDirection={v}")
+        warn_tdir = ~tdir_ok & leg_type.isin(['PI', 'HA', 'HF', 'HM'])
+        # speed
+        pt_spd = text('SPEED_LIMIT').str.strip()
+        pt_spd_descr = df['SPEED_LIMIT_DESCR']
+        spd_ok = pt_spd.str.len() > 0
+        spd = render(spd_ok, pt_spd, lambda v: f"Speed={v}")
+        spd[spd_ok & (pt_spd_descr == '+')] += "A"
+        spd[spd_ok & (pt_spd_descr == '-')] += "B"
+        # altitude, discrepancies with ARINC-424: G/H/I-@; J-+
+        pt_alt1 = df['ALT_1']
+        pt_alt_descr = df['ALT_DESCR']
+        alt_ok = pt_alt1.notna()
+        alt_a = alt_ok & pt_alt_descr.isin(['+', 'C', 'J', 'V'])
+        alt_b = alt_ok & pt_alt_descr.isin(['-', 'Y'])
+        alt_ab = alt_ok & (pt_alt_descr == 'B') & exported
+        alt = render(alt_ok & ~alt_a & ~alt_b & ~alt_ab, pt_alt1,
+                     lambda v: "Altitude=%d" % v)
+        alt[alt_a] = render(alt_a, pt_alt1, lambda v: "Altitude=%dA" % v)[alt_a]
+        alt[alt_b] = render(alt_b, pt_alt1, lambda v: "Altitude=%dB" % v)[alt_b]
+        if alt_ab.any():
+            alt[alt_ab] = ["Altitude=%dA%dB" % (a2, a1) for a1, a2 in
+                           zip(pt_alt1[alt_ab], df.loc[alt_ab, 'ALT_2'])]
+        warn_alt = ~alt_ok & leg_type.isin(['CA', 'VA', 'FA'])
+        # missed approach point: by finding 'M' in 4th char of WAYPOINT_DESCR_CODE
+        map_ = render(descr_ok & (pt_descr.str[3] == 'M'), pt_descr, lambda v: "MAP=1")
+        # frequency (using ident)
+        pt_navaid = text('RECOMMENDED_NAVAID').str.strip()
+        navaid_ok = pt_navaid.str.len() > 0
+        freq = render(navaid_ok, pt_navaid, lambda v: f"Frequency={v}")
+        warn_freq = ~navaid_ok & leg_type.isin(['PI', 'AF', 'CD', 'VD', 'CR', 'VR', 'FD'])
+        # slope
+        pt_angl = df['VERTICAL_ANGLE']
+        slope = render(pt_angl.notna(), pt_angl, lambda v: f"Slope={-float(v)}")
+        # NavBear
+        pt_navbear = df['THETA']
+        navbear = render(pt_navbear.notna(), pt_navbear,
+                         lambda v: "NavBear=%.01f" % (int(v)/10))
+        warn_navbear = pt_navbear.isna() & leg_type.isin(['PI', 'CR', 'VR'])
+        # NavDist
+        pt_dort = text('ROUTE_DISTANCE_HOLDING_DISTANCE_OR_TIME').str.strip()
+        dort_digit = pt_dort.str.isdigit().eq(True)
+        dist_legs = leg_type.isin(['CD', 'VD', 'FD'])
+        pt_navrho = df['RHO']
+        navdist = render(dist_legs & dort_digit, pt_dort,
+                         lambda v: "NavDist=%.01f" % (int(v)/10))
+        rho_ok = ~dist_legs & pt_navrho.notna()
+        navdist[rho_ok] = render(rho_ok, pt_navrho,
+                                 lambda v: "NavDist=%.01f" % (int(v)/10))[rho_ok]
+        warn_navdist = (dist_legs & ~dort_digit) | \
+            (~dist_legs & pt_navrho.isna() & leg_type.isin(['PI', 'AF']))
+        # dist
+        dort_time = pt_dort.str[:1] == 'T'
+        dist = render(dort_time, pt_dort, lambda v: "Dist=%d" % (int(v[1:])*1000))
+        dist_nm = ~dort_time & dort_digit
+        dist[dist_nm] = render(dist_nm, pt_dort,
+                               lambda v: "Dist=%.01f" % (int(v)/10))[dist_nm]
+        warn_dist = ~dort_time & ~dort_digit & leg_type.isin(['PI', 'HA', 'HF', 'HM', 'FC'])
+        # name, only for legs with a named fix
+        pt_name = df['FIX_IDENT']
+        name = render(leg_type.isin(FIX_LEG_TYPES) & pt_name.notna(), pt_name, lambda v: f"Name={v}")
+        self.name = name.to_list()
+        # in output order
+        body = [cross, hdg, tdir, spd, alt, map_, freq, slope, navbear, navdist, dist]
+        self.body = [c.to_list() for c in body]
+        # legs encoded to the same lines share a number
+        fields = pd.concat([leg_type.astype(object), name] + body, axis=1, ignore_index=True)
+        self.block = fields.groupby(list(fields.columns), sort=False, dropna=False).ngroup().to_numpy()
+        self.warns = [(kind, np.asarray(c, dtype=bool)) for kind, c in [
+            ("Heading", warn_hdg), ("TurnDirection", warn_tdir), ("Altitude", warn_alt),
+            ("Frequency", warn_freq), ("NavBear", warn_navbear), ("NavDist", warn_navdist),
+            ("Dist", warn_dist)]]
+
+
+FIX_LEG_TYPES = ['PI', 'HA', 'HF', 'HM', 'AF', 'CF', 'DF', 'FC', 'FD', 'RF', 'TF', 'IF']  # legs with a named fix
+
+
+def extract_leg(pos: int) -> Leg:
+    """resolve the fixes of the leg at row pos of the procedure table and log its warnings"""
+    legs = DATA.leg_table
+    STATS.counters['legs'] += 1
+    arpt = legs.arpt[pos]
+    leg_type = legs.leg_type[pos]
+    proc_name = legs.proc_name[pos]
+    pt_name = legs.pt_name[pos]
+    leg = Leg(pos)
     # find Lat/Lon
-    if leg_type in ['PI', 'HA', 'HF', 'HM', 'AF', 'CF', 'DF', 'FC', 'FD', 'RF', 'TF', 'IF']:
+    if leg_type in FIX_LEG_TYPES:
         if not pd.isna(pt_name):
-            extracted_lines.append(f"Name={pt_name}")
             latitude, longitude, msg = (0, 0, "")
-            if row['FIX_SUBS_CODE'] == 'G':  # use runway csv
-                rw_row = DF_RWY[(DF_RWY['ARPT_IDENT'] == arpt) &
-                                (DF_RWY['RUNWAY_IDENT'] == pt_name)]
-                if rw_row.shape[0]:
-                    latitude = rw_row['RUNWAY_LAT'].iloc[0]
-                    longitude = rw_row['RUNWAY_LON'].iloc[0]
+            if legs.fix_subs[pos] == 'G':  # use runway csv
+                rw_lat, rw_lon = DATA.fix_index.candidates('PG', pt_name, arpt)
+                STATS.counters['fix_lookups'] += 1
+                if len(rw_lat):
+                    latitude = rw_lat[0]
+                    longitude = rw_lon[0]
+                else:  # not logged
+                    STATS.misses["runway not found"] += 1
             else:
                 latitude, longitude, msg = find_a_point(
-                    pt_name, arpt, row['FIX_SECT_CODE'], row['FIX_SUBS_CODE'])
-            if latitude and longitude:
-                extracted_lines.append("Latitude=%.06f" % latitude)
-                extracted_lines.append("Longitude=%.06f" % longitude)
+                    pt_name, arpt, legs.fix_sect[pos], legs.fix_subs[pos])
+            leg.lat, leg.lon = latitude, longitude
             if len(msg):
                 print_debug_message(
                     f"[WARN] Lat/Lon for {arpt}:{proc_name}:{pt_name}:{msg}")
         else:
             print_debug_message(
                 f"[WARN] IDENT missing for {arpt}:{proc_name}")
-    # cross this point: by finding 'B/Y' in 2nd char of WAYPOINT_DESCR_CODE
-    pt_descr = row['WAYPOINT_DESCR_CODE']
-    if not pd.isna(pt_descr) and len(pt_descr) == 4 and pt_descr[1] in ['B', 'Y']:
-        extracted_lines.append("CrossThisPoint=1")
-    # heading
-    pt_hdg = row['MAG_COURSE']
-    if leg_type in ['PI', 'HA', 'HF', 'HM', 'FM', 'VM', 'CA', 'VA', 'CD', 'VD', 'CF', 'CI', 'VI', 'CR', 'VR', 'FA', 'FC', 'FD']:
-        if not pd.isna(pt_hdg):
-            extracted_lines.append("Heading=%.01f" % float(pt_hdg))
-        else:
-            print_debug_message(
-                f"[WARN] Heading missing for {arpt}:{proc_name}:{pt_name}")
-    # turn direction
-    pt_tdir = row['TURN_DIR']
-    if pt_tdir in ['L', 'R']:
-        extracted_lines.append(f"TurnDirection={pt_tdir}")
-    elif leg_type in ['PI', 'HA', 'HF', 'HM']:
-        print_debug_message(
-            f"[WARN] TurnDirection missing for {arpt}:{proc_name}:{pt_name}")
-    # speed
-    pt_spd = row['SPEED_LIMIT']
-    if not pd.isna(pt_spd) and len(pt_spd := pt_spd.strip()):
-        pt_spd_descr = row['SPEED_LIMIT_DESCR']
-        if pt_spd_descr == '+':
-            extracted_lines.append(f"Speed={pt_spd}A")
-        elif pt_spd_descr == '-':
-            extracted_lines.append(f"Speed={pt_spd}B")
-        else:
-            extracted_lines.append(f"Speed={pt_spd}")
-    # altitude
-    pt_alt1 = row['ALT_1']
-    if not pd.isna(pt_alt1):
-        pt_alt_descr = row['ALT_DESCR']
-        # discrepancies with ARINC-424: G/H/I-@; J-+
-        if pt_alt_descr in ['+', 'C', 'J', 'V']:
-            extracted_lines.append("Altitude=%dA" % pt_alt1)
-        elif pt_alt_descr in ['-', 'Y']:
-            extracted_lines.append("Altitude=%dB" % pt_alt1)
-        elif pt_alt_descr == 'B':
-            pt_alt2 = row['ALT_2']
-            extracted_lines.append("Altitude=%dA%dB" % (pt_alt2, pt_alt1))
-        else:
-            extracted_lines.append("Altitude=%d" % pt_alt1)
-    elif leg_type in ['CA', 'VA', 'FA']:
-        print_debug_message(
-            f"[WARN] Altitude missing for {arpt}:{proc_name}:{pt_name}")
-    # missed approach point: by finding 'M' in 4th char of WAYPOINT_DESCR_CODE
-    if not pd.isna(pt_descr) and len(pt_descr) == 4 and pt_descr[3] == 'M':
-        extracted_lines.append("MAP=1")
-    # frequency (using ident)
-    pt_navaid = row['RECOMMENDED_NAVAID']
-    if not pd.isna(pt_navaid) and len(pt_navaid := pt_navaid.strip()):
-        extracted_lines.append(f"Frequency={pt_navaid}")
-    elif leg_type in ['PI', 'AF', 'CD', 'VD', 'CR', 'VR', 'FD']:
-        print_debug_message(
-            f"[WARN] Frequency missing for {arpt}:{proc_name}:{pt_name}")
-    # slope
-    pt_angl = row['VERTICAL_ANGLE']
-    if not pd.isna(pt_angl):
-        extracted_lines.append(f"Slope={-float(pt_angl)}")
-    # NavBear
-    pt_navbear = row['THETA']
-    if not pd.isna(pt_navbear):
-        extracted_lines.append("NavBear=%.01f" % (int(pt_navbear)/10))
-    elif leg_type in ['PI', 'CR', 'VR']:
-        print_debug_message(
-            f"[WARN] NavBear missing for {arpt}:{proc_name}:{pt_name}")
-    # NavDist
-    if leg_type in ['CD', 'VD', 'FD']:
-        pt_dort = row['ROUTE_DISTANCE_HOLDING_DISTANCE_OR_TIME']
-        if not pd.isna(pt_dort) and len(pt_dort := pt_dort.strip()) and pt_dort.isdigit():
-            extracted_lines.append("NavDist=%.01f" % (int(pt_dort)/10))
-        else:
-            print_debug_message(
-                f"[WARN] NavDist missing for {arpt}:{proc_name}:{pt_name}")
-    else:
-        pt_navrho = row['RHO']
-        if not pd.isna(pt_navrho):
-            extracted_lines.append("NavDist=%.01f" % (int(pt_navrho)/10))
-        elif leg_type in ['PI', 'AF']:
+    # warnings of encoded fields
+    for kind, missing in legs.warns:
+        if missing[pos]:
             print_debug_message(
-                f"[WARN] NavDist missing for {arpt}:{proc_name}:{pt_name}")
-    # dist
-    pt_dort = row['ROUTE_DISTANCE_HOLDING_DISTANCE_OR_TIME']
-    if not pd.isna(pt_dort) and len(pt_dort := pt_dort.strip()) and pt_dort[0] == 'T':
-        extracted_lines.append("Dist=%d" % (int(pt_dort[1:])*1000))  # time
-    elif not pd.isna(pt_dort) and pt_dort.isdigit():  # n miles
-        extracted_lines.append("Dist=%.01f" % (int(pt_dort)/10))
-    elif leg_type in ['PI', 'HA', 'HF', 'HM', 'FC']:
-        print_debug_message(
-            f"[WARN] Dist missing for {arpt}:{proc_name}:{pt_name}")
+                f"[WARN] {kind} missing for {arpt}:{proc_name}:{pt_name}")
     # Center lat/lon
     if leg_type == 'RF':
-        pt_cfix = row['CENTER_FIX_OR_TAA_PROCEDURE_TURN_IND'].strip()
+        pt_cfix = legs.cfix[pos].strip()
         if len(pt_cfix):
             latitude, longitude, msg = find_a_point(
-                pt_cfix, arpt, row['MULTIPLE_CODE_OR_TAA_SECTOR_SECT_CODE'], row['MULTIPLE_CODE_OR_TAA_SECTOR_SUBS_CODE'])
-            if latitude and longitude:
-                extracted_lines.append("CenterLat=%.06f" % latitude)
-                extracted_lines.append("CenterLon=%.06f" % longitude)
+                pt_cfix, arpt, legs.cfix_sect[pos], legs.cfix_subs[pos])
+            leg.center_lat, leg.center_lon = latitude, longitude
             if len(msg):
                 print_debug_message(
                     f"[WARN] RF center for {arpt}:{proc_name}:{pt_cfix}:{msg}")
         else:
             print_debug_message(
                 f"[WARN] RF center missing for {arpt}:{proc_name}:{pt_name}")
-    return extracted_lines
+    return leg
 
 
-def find_a_point(ident: str, airport: str, sect_code: str, subs_code: str) -> tuple:
-    """returns (lat, lon, msg) tuple"""
-    arpt_row = DF_APT[DF_APT['ARPT_IDENT'] == airport]
-    if not arpt_row.shape[0]:
-        return (0, 0, "airport not found")
-    arpt_lat, arpt_lon = arpt_row.iloc[0][['ARPT_LAT', 'ARPT_LON']].to_list()
-    if sect_code == 'E':  # enroute waypoint
-        p_match = DF_WPT[(DF_WPT['WAYPOINT_IDENT'] == ident) &
-                         (DF_WPT['SECT_CODE'] == 'E')]
-        if p_match.shape[0]:
-            p_all = pd.DataFrame(
-                {'LAT': p_match['WAYPOINT_LAT'],
-                 'LON': p_match['WAYPOINT_LON'],
-                 'DIS': 1000})
+def render_leg(leg: Leg) -> list:
+    """return a list of lines (without header) of the leg"""
+    legs = DATA.leg_table
+    pos = leg.pos
+    lines = [legs.head[pos]]
+    if legs.name[pos]:
+        lines.append(legs.name[pos])
+        if leg.lat and leg.lon:
+            lines.append("Latitude=%.06f" % leg.lat)
+            lines.append("Longitude=%.06f" % leg.lon)
+    lines.extend(c[pos] for c in legs.body if c[pos])
+    if leg.center_lat and leg.center_lon:
+        lines.append("CenterLat=%.06f" % leg.center_lat)
+        lines.append("CenterLon=%.06f" % leg.center_lon)
+    return lines
+
+
+class LegBlocks:
+    """rendered text of legs by content (encoded fields and resolved coordinates),
+    each distinct block is rendered once and then emitted by reference"""
+
+    def __init__(self) -> None:
+        self.blocks = {}
+
+    def get(self, leg: Leg, count: bool = True) -> str:
+        key = (DATA.leg_table.block[leg.pos], leg.lat, leg.lon, leg.center_lat, leg.center_lon)
+        block = self.blocks.get(key)
+        if not count:
+            return block if block is not None else '\n'.join(render_leg(leg))
+        if block is None:
+            block = self.blocks[key] = '\n'.join(render_leg(leg))
+            STATS.counters['leg_blocks'] += 1
+            STATS.counters['leg_block_bytes'] += len(block)
         else:
-            return (0, 0, "enroute waypoint not found")
-    elif sect_code == 'P' and subs_code == 'C':  # terminal waypoint
-        p_match = DF_WPT[(DF_WPT['WAYPOINT_IDENT'] == ident) &
-                         (DF_WPT['REGION_CODE'] == airport)]
-        if p_match.shape[0]:
-            p_all = pd.DataFrame(
-                {'LAT': p_match['WAYPOINT_LAT'],
-                 'LON': p_match['WAYPOINT_LON'],
-                 'DIS': 1000})
+            STATS.counters['leg_blocks_reused'] += 1
+            STATS.counters['leg_block_bytes_reused'] += len(block)
+        return block
+
+
+def render_procedures(procedures: dict, blocks: LegBlocks) -> str:
+    """return the iFly text of {name: [Leg]}, in name order"""
+    names = sorted(procedures.keys())
+    lines = ["[list]"]
+    lines.extend(f"Procedure.{i}={pn}" for i, pn in enumerate(names))
+    for pn in names:
+        for k, leg in enumerate(procedures[pn]):
+            lines.append(f"[{pn}.{k}]")
+            lines.append(blocks.get(leg))
+    return '\n'.join(lines)
+
+
+def procedure_records(arpt: str, name: str, procedures: dict, blocks: LegBlocks) -> list:
+    """return the rows of ProcedureDatabase.add for the file name holding {name: [Leg]}"""
+    legs = DATA.leg_table
+    kind = name.rsplit('.', 1)[1]
+    records = []
+    for i, pn in enumerate(sorted(procedures.keys())):
+        head, _, tail = pn.partition('.')
+        ident, runway, transition = (tail, None, head) if kind.endswith('trs') else (head, tail, None)
+        leg_rows = []
+        for k, leg in enumerate(procedures[pn]):
+            pos = leg.pos
+            cfix = legs.cfix[pos]
+            located = bool(legs.name[pos] and leg.lat and leg.lon)
+            centered = bool(leg.center_lat and leg.center_lon)
+            leg_rows.append((k, legs.leg_type[pos], legs.pt_name[pos] if legs.name[pos] else None,
+                             leg.lat if located else None, leg.lon if located else None,
+                             cfix.strip() if centered else None,
+                             leg.center_lat if centered else None, leg.center_lon if centered else None,
+                             blocks.get(leg, count=False)))
+        records.append((arpt, kind, name, i, pn, ident, runway, transition, leg_rows))
+    return records
+
+
+def write_procedures(sink: OutputSink, arpt: str, name: str, procedures: dict, blocks: LegBlocks) -> None:
+    """writes the file name of {name: [Leg]}, and its records if the sink keeps them"""
+    sink.write(name, render_procedures(procedures, blocks))
+    if sink.records:
+        sink.add_records(procedure_records(arpt, name, procedures, blocks))
+
+
+EARTH_RADIUS = 6371  # km
+
+
+def unit_vectors(lat, lon) -> np.ndarray:
+    """returns (n, 3) points on the unit sphere, args in degrees"""
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+def chord_to_distance(chord):
+    """straight line distance between unit vectors to great circle kilometers"""
+    return 2 * EARTH_RADIUS * np.arcsin(np.minimum(chord / 2, 1))
+
+
+class FixIndex:
+    """coordinates of all fixes, grouped once by (section, ident, scope)"""
+
+    def __init__(self, df_apt: pd.DataFrame, df_rwy: pd.DataFrame, df_wpt: pd.DataFrame,
+                 df_vhf: pd.DataFrame, df_ndb: pd.DataFrame) -> None:
+        df_apt = df_apt.drop_duplicates('ARPT_IDENT', keep='first')
+        self.airports = dict(zip(df_apt['ARPT_IDENT'],
+                                 zip(df_apt['ARPT_LAT'], df_apt['ARPT_LON'])))
+        self.slices = {}
+        self.sections = {}  # section: (start, stop)
+        self.keys = []  # (section, ident, scope) of each group
+        parts = []  # (lat, lon, group number, row) arrays, concatenated below
+        offset = 0
+        df_enr = df_wpt[df_wpt['SECT_CODE'] == 'E']
+        df_ndb_d = df_ndb[df_ndb['SECT_CODE'] == 'D']
+        df_ndb_p = df_ndb[df_ndb['SECT_CODE'] == 'P']
+        for sect, df, ident_col, scope_col, lat_col, lon_col in [
+            ('E', df_enr, 'WAYPOINT_IDENT', None, 'WAYPOINT_LAT', 'WAYPOINT_LON'),
+            ('PC', df_wpt, 'WAYPOINT_IDENT', 'REGION_CODE', 'WAYPOINT_LAT', 'WAYPOINT_LON'),
+            ('D', df_vhf, 'VOR_IDENT', None, 'VOR_LAT', 'VOR_LON'),
+            ('DB', df_ndb_d, 'NDB_IDENT', None, 'NDB_LAT', 'NDB_LON'),
+            ('PN', df_ndb_p, 'NDB_IDENT', None, 'NDB_LAT', 'NDB_LON'),
+            ('PG', df_rwy, 'RUNWAY_IDENT', 'ARPT_IDENT', 'RUNWAY_LAT', 'RUNWAY_LON'),
+        ]:
+            key_cols = [ident_col] if scope_col is None else [ident_col, scope_col]
+            df = df.dropna(subset=key_cols)
+            if not df.shape[0]:
+                continue
+            codes = df.groupby(key_cols, sort=False).ngroup().to_numpy()
+            order = np.argsort(codes, kind='stable')  # keeps file order in group
+            starts = np.flatnonzero(np.diff(codes[order], prepend=-1))
+            stops = np.append(starts[1:], len(order))
+            idents = df[ident_col].to_numpy()[order[starts]]
+            scopes = [None] * len(starts) if scope_col is None else \
+                df[scope_col].to_numpy()[order[starts]]
+            first_group = len(self.keys)
+            for ident, scope, start, stop in zip(idents, scopes, starts, stops):
+                self.slices[(sect, ident, scope)] = (offset + start, offset + stop)
+                self.keys.append((sect, ident, scope))
+            parts.append((df[lat_col].to_numpy(dtype=float)[order],
+                          df[lon_col].to_numpy(dtype=float)[order],
+                          np.repeat(np.arange(first_group, len(self.keys)), stops - starts),
+                          df.index.to_numpy()[order]))
+            self.sections[sect] = (offset, offset + len(order))
+            offset += len(order)
+        self.lat = np.concatenate([p[0] for p in parts]) if parts else np.empty(0)
+        self.lon = np.concatenate([p[1] for p in parts]) if parts else np.empty(0)
+        self.group = np.concatenate([p[2] for p in parts]) if parts else np.empty(0, dtype=int)
+        self.rows = np.concatenate([p[3] for p in parts]) if parts else np.empty(0, dtype=int)  # index labels
+        self.xyz = unit_vectors(self.lat, self.lon)
+
+    def candidates(self, sect: str, ident: str, scope: str = None) -> tuple:
+        """returns (lat, lon) arrays of all matches, empty if none"""
+        start, stop = self.slices.get((sect, ident, scope), (0, 0))
+        return (self.lat[start:stop], self.lon[start:stop])
+
+    def nearest(self, lat: float, lon: float, sect: str, ident: str, scope: str = None) -> tuple:
+        """returns (position, distance in km) of the match nearest to (lat, lon), None if none"""
+        start, stop = self.slices.get((sect, ident, scope), (0, 0))
+        if start == stop:
+            return None
+        chord = np.linalg.norm(self.xyz[start:stop] - unit_vectors(lat, lon), axis=1)
+        i = 0 if stop - start == 1 or np.isnan(chord).all() else int(np.nanargmin(chord))
+        return (start + i, float(chord_to_distance(chord[i])))
+
+    @classmethod
+    def of_table(cls, name: str, df: pd.DataFrame) -> 'FixIndex':
+        """index of the fixes of df, read from the fix table name, the other tables empty"""
+        tables = {table: pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in FSL_SCHEMA[table].items()})
+                  for table in ['AIRPORT', 'RUNWAY', 'WAYPOINT', 'VHF_NAVAID', 'NDB_NAVAID']}
+        tables[name] = df
+        return cls(*tables.values())
+
+    @cached_property
+    def grid(self) -> 'SpatialGrid':
+        """waypoints and navaids, the terminal section holds every row of WAYPOINT.csv"""
+        positions = [np.arange(*self.sections[s]) for s in ['PC', 'D', 'DB', 'PN'] if s in self.sections]
+        return SpatialGrid(self.lat, self.lon, self.xyz,
+                           np.concatenate(positions) if positions else np.empty(0, dtype=int))
+
+    def within(self, lat: float, lon: float, radius_km: float) -> list:
+        """returns [((section, ident, scope), distance in km, index label of the row in its table)]
+        of waypoints and navaids within radius_km of (lat, lon), nearest first"""
+        positions, distances = self.grid.within(lat, lon, radius_km)
+        return [(self.keys[g], d, row) for g, d, row in
+                zip(self.group[positions], distances.tolist(), self.rows[positions].tolist())]
+
+
+class SpatialGrid:
+    """points bucketed into cells of cell_deg x cell_deg degrees, for radius queries"""
+
+    def __init__(self, lat: np.ndarray, lon: np.ndarray, xyz: np.ndarray, positions: np.ndarray,
+                 cell_deg: float = 1.0) -> None:
+        positions = positions[np.isfinite(lat[positions]) & np.isfinite(lon[positions])]
+        self.cell_deg = cell_deg
+        self.n_rows = int(np.ceil(180 / cell_deg))
+        self.n_cols = int(np.ceil(360 / cell_deg))
+        self.xyz = xyz
+        cells = self.row(lat[positions]) * self.n_cols + self.col(lon[positions])
+        order = np.argsort(cells, kind='stable')
+        self.cells = cells[order]
+        self.positions = positions[order]
+
+    def row(self, lat):
+        return np.clip(np.floor_divide(np.add(lat, 90), self.cell_deg).astype(int), 0, self.n_rows - 1)
+
+    def col(self, lon):
+        return np.floor_divide(np.add(lon, 180), self.cell_deg).astype(int) % self.n_cols
+
+    def within(self, lat: float, lon: float, radius_km: float) -> tuple:
+        """returns (positions, distances in km) of points within radius_km of (lat, lon), nearest first"""
+        angle = radius_km / EARTH_RADIUS
+        dlat = np.degrees(angle)
+        rows = np.arange(self.row(lat - dlat), self.row(lat + dlat) + 1)
+        if abs(lat) + dlat >= 90 or np.sin(angle) >= np.cos(np.radians(lat)):  # cap spans all longitudes
+            col_ranges = [(0, self.n_cols - 1)]
         else:
-            return (0, 0, "terminal waypoint not found")
+            dlon = np.degrees(np.arcsin(np.sin(angle) / np.cos(np.radians(lat))))
+            col_lo, col_hi = self.col(lon - dlon), self.col(lon + dlon)
+            if 2 * dlon + self.cell_deg >= 360:
+                col_ranges = [(0, self.n_cols - 1)]
+            elif col_lo <= col_hi:
+                col_ranges = [(col_lo, col_hi)]
+            else:  # across the antimeridian
+                col_ranges = [(col_lo, self.n_cols - 1), (0, col_hi)]
+        lows = np.concatenate([rows * self.n_cols + lo for lo, _ in col_ranges])
+        highs = np.concatenate([rows * self.n_cols + hi for _, hi in col_ranges])
+        starts = np.searchsorted(self.cells, lows, 'left')
+        stops = np.searchsorted(self.cells, highs, 'right')
+        positions = np.concatenate([self.positions[a:b] for a, b in zip(starts, stops)])
+        distances = chord_to_distance(np.linalg.norm(self.xyz[positions] - unit_vectors(lat, lon), axis=1))
+        keep = distances <= radius_km
+        order = np.argsort(distances[keep], kind='stable')
+        return (positions[keep][order], distances[keep][order])
+
+
+FIX_SECTIONS = {  # section in FixIndex: point type
+    'E': "enroute waypoint",
+    'PC': "terminal waypoint",
+    'D': "VOR",
+    'DB': "NDB",
+    'PN': "NDB",
+    'PG': "runway",
+}
+
+
+def fix_section(sect_code: str, subs_code: str) -> str:
+    """returns the FixIndex section of a point, empty if unknown"""
+    if sect_code == 'E':  # enroute waypoint
+        return 'E'
+    elif sect_code == 'P' and subs_code == 'C':  # terminal waypoint
+        return 'PC'
     elif sect_code == 'D' and (pd.isna(subs_code) or not len(subs_code.strip())):  # VOR
-        p_match = DF_VHF[DF_VHF['VOR_IDENT'] == ident]
-        if p_match.shape[0]:
-            p_all = pd.DataFrame(
-                {'LAT': p_match['VOR_LAT'],
-                 'LON': p_match['VOR_LON'],
-                 'DIS': 1000})
-        else:
-            return (0, 0, "VOR not found")
+        return 'D'
     elif (sect_code == 'D' and subs_code == 'B') or \
             (sect_code == 'P' and subs_code == 'N'):  # NDB
-        p_match = DF_NDB[(DF_NDB['NDB_IDENT'] == ident) &
-                         (DF_NDB['SECT_CODE'] == sect_code)]
-        if p_match.shape[0]:
-            p_all = pd.DataFrame(
-                {'LAT': p_match['NDB_LAT'],
-                 'LON': p_match['NDB_LON'],
-                 'DIS': 1000})
-        else:
-            return (0, 0, "NDB not found")
+        return sect_code + subs_code
     elif sect_code == 'P' and subs_code == 'G':  # runway
-        p_match = DF_RWY[(DF_RWY['ARPT_IDENT'] == airport) &
-                         (DF_RWY['RUNWAY_IDENT'] == ident)]
-        if p_match.shape[0]:
-            p_all = pd.DataFrame(
-                {'LAT': p_match['RUNWAY_LAT'],
-                 'LON': p_match['RUNWAY_LON'],
-                 'DIS': 1000})
-        else:
-            return (0, 0, "runway not found")
-    else:  # unknown
+        return 'PG'
+    return ''
+
+
+def find_a_point(ident: str, airport: str, sect_code: str, subs_code: str) -> tuple:
+    """returns (lat, lon, msg) tuple, counted in STATS"""
+    lat, lon, msg = locate_point(ident, airport, sect_code, subs_code)
+    STATS.counters['fix_lookups'] += 1
+    if msg:
+        STATS.misses[msg] += 1
+    return (lat, lon, msg)
+
+
+def locate_point(ident: str, airport: str, sect_code: str, subs_code: str) -> tuple:
+    """returns (lat, lon, msg) tuple"""
+    index = DATA.fix_index
+    if airport not in index.airports:
+        return (0, 0, "airport not found")
+    arpt_lat, arpt_lon = index.airports[airport]
+    sect = fix_section(sect_code, subs_code)
+    if not sect:  # unknown
         return (0, 0, "unknown type point")
-    p_all['DIS'] = p_all[['LAT', 'LON']].apply(lambda r: calculate_distance(
-        r['LAT'], r['LON'], arpt_lat, arpt_lon), axis=1)
-    p_all.sort_values('DIS', ascending=True, inplace=True)
-    msg = "too far" if p_all.iloc[0, 2] >= 1000 else ""
-    return (p_all.iloc[0, 0], p_all.iloc[0, 1], msg)
-
-
-def calculate_distance(lat1, lon1, lat2, lon2):
-    """Haversine formula. Args in degrees. Returns in kilometers."""
-    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
-    earth_radius = 6371
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-    a = math.sin(dlat / 2) ** 2 + math.cos(lat1) * \
-        math.cos(lat2) * math.sin(dlon / 2) ** 2
-    c = 2 * math.asin(math.sqrt(a))
-    distance = earth_radius * c
-    return distance
+    found = index.nearest(arpt_lat, arpt_lon, sect, ident, airport if sect in ['PC', 'PG'] else None)
+    if found is None:
+        return (0, 0, f"{FIX_SECTIONS[sect]} not found")
+    i, p_dis = found
+    msg = "too far" if p_dis >= 1000 else ""
+    return (index.lat[i], index.lon[i], msg)
 
 
 def print_debug_message(msg: str) -> None:
     LOG.append(msg)
-    print(msg)
+    if ECHO and not (QUIET and msg.startswith(EXPORTED)):
+        print(msg)
 
 
 if __name__ == "__main__":
-    main()
-    input("Press Enter to exit...")
+    parser = argparse.ArgumentParser(description="Converts FSL NavData csv to iFly Supplemental NavData")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="number of worker processes for SID/STAR/APP export (default: 1)")
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help="only regenerate airports whose input rows changed since the last incremental run")
+    parser.add_argument('-p', '--products', nargs='+', choices=PRODUCTS, default=PRODUCTS,
+                        help="products to export (default: all)")
+    parser.add_argument('--package', choices=['both', 'dir', 'zip'], default='both',
+                        help="write the output directory, the zip package or both (default: both)")
+    parser.add_argument('--prefixes', nargs='+', default=[], metavar='PREFIX',
+                        help="only convert airports whose ident starts with one of these, e.g. Z")
+    parser.add_argument('--airports', nargs='+', default=[], metavar='ICAO',
+                        help="only convert these airports (together with --prefixes)")
+    parser.add_argument('--bbox', nargs=4, type=float, metavar=('MIN_LAT', 'MIN_LON', 'MAX_LAT', 'MAX_LON'),
+                        help="only convert airports located in this box")
+    parser.add_argument('--radius', type=float, default=0,
+                        help="with a subset, also keep fixes within this many km of its airports (default: 0)")
+    parser.add_argument('--stream', type=float, default=0, metavar='MB',
+                        help="convert AIRPORT_PROCEDURE.csv a part at a time, sized to keep resident memory under MB "
+                             "(not with --jobs or --incremental)")
+    parser.add_argument('--database', nargs='?', const=f"{output_dir}.sqlite", default='', metavar='PATH',
+                        help="also write procedures and legs to an SQLite database (default: {output_dir}.sqlite)")
+    parser.add_argument('--serve', type=int, nargs='?', const=8424, metavar='PORT',
+                        help="keep the cycle loaded and convert single airports over HTTP on localhost "
+                             "(default port: 8424)")
+    parser.add_argument('--cache-size', type=int, default=256,
+                        help="airports kept by --serve (default: 256)")
+    parser.add_argument('--batch', nargs='+', metavar='DIR',
+                        help="convert several cycles given as FSL_DIR OUTPUT_DIR pairs instead of directories.py, "
+                             "tables with the same content are loaded once")
+    parser.add_argument('--batch-workers', type=int, default=0, metavar='N',
+                        help="cycles converted at once by --batch (default: one per cycle up to the cpu count)")
+    parser.add_argument('--batch-report', default='', metavar='PATH',
+                        help="write the combined timing summary of --batch to this json file")
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help="do not print a line per exported file, Log.txt still has them")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="add peak Python allocations per stage to Report.json, slows conversion down")
+    args = parser.parse_args()
+    subset = None
+    if args.prefixes or args.airports or args.bbox:
+        subset = Subset(tuple(args.prefixes), tuple(args.airports),
+                        tuple(args.bbox) if args.bbox else None, args.radius)
+    if args.batch and len(args.batch) % 2:
+        parser.error("--batch takes FSL_DIR OUTPUT_DIR pairs")
+    if args.serve is not None:
+        serve(base_dir, output_dir, args.serve, snapshot_dir, args.cache_size)
+    elif args.batch:
+        batch(list(zip(args.batch[::2], args.batch[1::2])), args.batch_workers, snapshot=bool(snapshot_dir),
+              database=bool(args.database), report_path=args.batch_report,
+              jobs=args.jobs, incremental=args.incremental, products=args.products, package=args.package,
+              quiet=args.quiet, trace_memory=args.trace_memory, subset=subset, stream_mb=args.stream)
+        input("Press Enter to exit...")
+    else:
+        main(jobs=args.jobs, incremental=args.incremental, products=args.products, package=args.package,
+             quiet=args.quiet, trace_memory=args.trace_memory, subset=subset, stream_mb=args.stream,
+             database=args.database)
+        input("Press Enter to exit...")